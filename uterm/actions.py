@@ -1,59 +1,510 @@
 from __future__ import unicode_literals
+import base64
+import binascii
+import collections
+import io
+import json
 import os
+import posixpath
+import tempfile
+import time
+import zlib
 
 import curses
 
-from .comms import Comms
-from . import browser
+from . import agent, browser
+from .cache import DeviceCache
+from .comms import Timeout
+from .scrollback import Viewer
+from .browser import pad
+
+# Device side expressions which decode an encoded chunk.
+ENCODINGS = {
+    'repr': lambda data: repr(data).encode(),
+    'base64': lambda data: (
+        b"binascii.a2b_base64('" + base64.b64encode(data) + b"')"),
+    'hex': lambda data: (
+        b"binascii.unhexlify('" + binascii.hexlify(data) + b"')"),
+}
+
+# Compression window size. Kept small since the device has to allocate a
+# window buffer of 2 ** WBITS bytes to inflate.
+WBITS = 10
+
+# Device side source which defines ``_z``, wrapping a stream with whichever
+# decompressor the firmware has.
+DECOMPRESSOR = '''\
+try:
+    import deflate
+    _z = lambda f: deflate.DeflateIO(f, deflate.ZLIB)
+except ImportError:
+    try:
+        from zlib import DecompIO
+        _z = lambda f: DecompIO(f, %d)
+    except ImportError:
+        _z = None
+print(_z is not None)
+'''
+
+# Device side source which inflates one file to another.
+INFLATE = '''\
+import os
+_s = open(%r, 'rb')
+_d = _z(_s)
+_o = open(%r, 'wb')
+while True:
+    _b = _d.read(256)
+    if not _b:
+        break
+    _o.write(_b)
+_o.close()
+_s.close()
+os.remove(%r)
+del _s, _d, _o, _b, _z
+'''
+
+# Device side source which opens the upload's temporary file and defines
+# ``_fhw``, which writes a chunk at an offset only if its CRC is correct (or
+# not given, for firmware without ``binascii.crc32``).
+OPEN = '''\
+import binascii
+_fh = open(%r, %r)
+def _fhw(d, c, o):
+    if c is None or (binascii.crc32(d) & 0xffffffff) == c:
+        _fh.seek(o)
+        _fh.write(d)
+    else:
+        print('CRC')
+'''
+
+# Device side source which prints the [offset, CRC] of each block of a
+# partially uploaded file.
+CHECKPOINTS = '''\
+import binascii, json
+_r = []
+try:
+    with open(%r, 'rb') as _f:
+        _o = _c = 0
+        while True:
+            _b = _f.read(%d)
+            if not _b:
+                break
+            _o += len(_b)
+            _c = binascii.crc32(_b, _c)
+            _r.append([_o, _c & 0xffffffff])
+except OSError:
+    pass
+print(json.dumps(_r))
+'''
+
+# Device side source which replaces a file with the upload's temporary file
+# and forgets any previous import of the module.
+REPLACE = '''\
+import os, sys
+try:
+    os.remove(%r)
+except OSError:
+    pass
+os.rename(%r, %r)
+sys.modules.pop(%r, None)
+'''
+
+# Device side source which creates any of a list of directories that don't
+# exist yet.
+MKDIRS = '''\
+import os
+for _d in %r:
+    try:
+        os.mkdir(_d)
+    except OSError:
+        pass
+'''
+
+
+def encode_chunk(data, encoding='auto'):
+    """
+    Return a device side expression which evaluates to the bytes of ``data``.
+
+    The ``auto`` encoding measures each chunk, using a bytes literal for
+    mostly-printable data and base64 when escaping would bloat the literal
+    more than base64 does.
+    """
+    if encoding != 'auto':
+        return ENCODINGS[encoding](data)
+    return min(
+        (ENCODINGS[name](data) for name in ('repr', 'base64')), key=len)
 
 
 class Uploader(object):
+    """
+    Upload a local file to the device's current directory (or to
+    ``remote_name``, relative to that directory).
+
+    The file is written to a temporary ``_<name>`` file which is renamed
+    once complete. Data is streamed using the raw REPL's raw-paste mode if
+    the firmware supports it, falling back to friendly REPL statements.
+
+    Chunks are sent as bytes literals or, for binary data where escaping
+    would bloat the literal, base64 which the device decodes with
+    ``binascii``. Pass ``encoding`` to force one of :data:`ENCODINGS`.
+
+    Each chunk is sent with its CRC and only written if the device
+    calculates the same CRC, otherwise it is retransmitted. If a previous
+    upload of the same file was interrupted, the verified part of the
+    temporary file left behind is kept and the upload continues from there.
+    Firmware without ``binascii.crc32`` gets unverified chunks (and no
+    resuming) instead.
 
-    def __init__(self, name, update_func=None):
+    Set ``compress`` to deflate the file before sending it, for the device
+    to inflate (if its firmware has a decompressor, otherwise the file is
+    sent uncompressed).
+
+    Attributes:
+        bytes_per_second (float): effective upload rate of the last call
+        overhead (float): bytes sent on the wire per byte of the file
+        checkpoint (int): offset of the data verified on the device so far
+    """
+    chunk_size = 60
+    raw_chunk_size = 2048
+    retries = 3
+    # Friendly REPL statements to keep in flight.
+    window = 4
+
+    def __init__(
+            self, name, update_func=None, encoding='auto', remote_name=None,
+            compress=False):
         self.path = os.path.normpath(name)
-        self.name = os.path.basename(name)
+        self.name = remote_name or os.path.basename(name)
         self.update_func = update_func
+        self.encoding = encoding
+        self.compress = compress
+        self.bytes_per_second = None
+        self.overhead = None
+        self.wire_bytes = 0
+        self.checkpoint = 0
+        self.verify = True
 
     def update(self, amount):
         if self.update_func:
             self.update_func(amount)
 
-    def __call__(self, terminal):
-        temp_name = '_{}'.format(self.name)
-        comms = Comms(terminal, silent=True)
-        comms.send('_fh = open(%r, "wb")' % temp_name)
-        comms.send('_fhw = lambda text: _fh.write(text) and None')
+    def __call__(self, terminal, comms=None):
+        """
+        Upload the file. Pass ``comms`` to reuse a session other than the
+        terminal's (which may be left in the raw REPL).
+        """
+        if comms:
+            return self.upload(comms)
+        comms = terminal.comms
+        try:
+            return self.upload(comms)
+        finally:
+            # Don't leave the terminal's session in the raw REPL, even if
+            # the upload failed.
+            comms.exit_raw()
+
+    def upload(self, comms):
+        directory, base = posixpath.split(self.name)
+        temp_name = posixpath.join(directory, '_{}'.format(base))
+        module, ext = posixpath.splitext(self.name)
+        module = module.replace('/', '.') if ext in ('.py', '.mpy') else None
         with open(self.path, 'rb') as fh:
-            fh.seek(0, 2)
-            total = float(fh.tell())
-            fh.seek(0)
-            self.update(0)
-            while True:
-                data = fh.read(60)
-                if not data:
-                    self.update(1)
-                    break
-                self.update(fh.tell() / total)
-                comms.send(b'_fhw(' + repr(data).encode() + b')')
-            comms.send('_fh.close()')
-            comms.import_module('os')
-            comms.send(
-                # Note the explicit second \r to ensure the statement is
-                # executed.
-                b'if %r in os.listdir(): os.remove(%r)\r' % (
-                    self.name, self.name))
-            comms.send('os.rename(%r, %r)' % (temp_name, self.name))
-            module, ext = os.path.splitext(self.name)
-            if ext in ('.py', '.mpy'):
-                comms.import_module('sys')
-                # Note the explicit second \r to ensure the statement is
-                # executed.
-                comms.send('if %r in sys.modules: del sys.modules[%r]\r' % (
-                    module, module))
+            data = fh.read()
+        self.size = len(data)
+        self.update(0)
+        self.started = time.time()
+        self.wire_bytes = 0
+        if not comms.raw:
+            comms.enter_raw()
+        self.verify = self.has_crc32(comms)
+        compressed = self.compress and self.has_decompressor(comms)
+        if compressed:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, WBITS)
+            data = compressor.compress(data) + compressor.flush()
+            write_name = temp_name + '.z'
+        else:
+            write_name = temp_name
+        self.checkpoint = self.verified_offset(comms, write_name, data)
+        mode = 'r+b' if self.checkpoint else 'wb'
+        if agent.installed(comms):
+            # Base64 chunks need binascii (which OPEN would import).
+            comms.raw_exec(
+                'import binascii\n_fh = _fhw = %s.Writer(%r, %r)' % (
+                    agent.NAME, write_name, mode))
+        else:
+            comms.raw_exec(OPEN % (write_name, mode))
+        fh = io.BytesIO(data)
+        fh.seek(self.checkpoint)
+        total = float(len(data))
+        if comms.raw_paste:
+            self.write_raw(comms, fh, total)
+            finish = '_fh.close()\n'
+            if compressed:
+                finish += INFLATE % (write_name, temp_name, write_name)
+            comms.raw_exec(
+                finish + REPLACE % (self.name, temp_name, self.name, module),
+                timeout=30)
+            self.update(1)
+            return True
+        comms.exit_raw()
+        self.write_repl(comms, fh, total)
+        comms.send('_fh.close()')
+        if compressed:
+            comms.enter_raw()
+            comms.raw_exec(
+                INFLATE % (write_name, temp_name, write_name), timeout=30)
+            comms.exit_raw()
+        self.update(1)
+        comms.import_module('os')
+        listdir = 'os.listdir(%r)' % directory if directory else (
+            'os.listdir()')
+        comms.send(
+            # Note the explicit second \r to ensure the statement is
+            # executed.
+            'if %r in %s: os.remove(%r)\r' % (base, listdir, self.name))
+        comms.send('os.rename(%r, %r)' % (temp_name, self.name))
+        if module:
+            comms.import_module('sys')
+            # Note the explicit second \r to ensure the statement is
+            # executed.
+            comms.send('if %r in sys.modules: del sys.modules[%r]\r' % (
+                module, module))
+
+        return True
+
+    def has_crc32(self, comms):
+        """
+        Check (once per session) whether the firmware can verify chunks with
+        ``binascii.crc32``.
+        """
+        if comms.crc32 is None:
+            comms.crc32 = comms.json_batch(
+                ["hasattr(__import__('binascii'), 'crc32')"])[0] is True
+        return comms.crc32
+
+    def has_decompressor(self, comms):
+        """
+        Check whether the firmware can inflate a compressed upload (defining
+        the device side ``_z`` helper if it can).
+        """
+        # Importing the decompressor can take a while on a slow device.
+        return comms.raw_exec(
+            DECOMPRESSOR % WBITS, timeout=10).strip() == b'True'
+
+    def verified_offset(self, comms, name, data):
+        """
+        Find how much of ``data`` a previous, interrupted upload already
+        wrote to the device, by comparing CRCs of each block.
+        """
+        offset = crc = 0
+        if not self.verify:
+            return offset
+        if agent.installed(comms):
+            source = agent.call('crcs', name, self.raw_chunk_size)
+        else:
+            source = CHECKPOINTS % (name, self.raw_chunk_size)
+        checkpoints = json.loads(
+            comms.raw_exec(source, timeout=30).decode())
+        if checkpoints and checkpoints[-1][0] > len(data):
+            # Leftovers of a larger file can't be resumed.
+            return 0
+        for end, remote_crc in checkpoints:
+            crc = binascii.crc32(data[offset:end], crc)
+            if (crc & 0xffffffff) != remote_crc:
+                break
+            offset = end
+        return offset
+
+    def chunks(self, fh, size):
+        while True:
+            offset = fh.tell()
+            data = fh.read(size)
+            if not data:
+                break
+            yield offset, data
+
+    def write_raw(self, comms, fh, total):
+        """
+        Stream the file in large chunks using raw-paste mode.
+        """
+        def send(statement):
+            return comms.raw_exec(statement).decode('utf-8', 'replace')
+
+        for offset, data in self.chunks(fh, self.raw_chunk_size):
+            self.write_chunk(offset, data, send, comms.enter_raw)
+            self.checkpoint = fh.tell()
+            self.progress(self.checkpoint, total)
+
+    def write_repl(self, comms, fh, total):
+        """
+        Write the file in small chunks using friendly REPL statements,
+        pipelined so several are in flight at once.
+        """
+        sent = collections.deque()
+        failed = []
+
+        def statements():
+            for offset, data in self.chunks(fh, self.chunk_size):
+                sent.append((offset, data))
+                yield self.statement(offset, data)
+
+        for statement, output in comms.pipeline(
+                statements(), window=self.window, raise_errors=False):
+            offset, data = sent.popleft()
+            if self.verified(output):
+                if not failed:
+                    self.checkpoint = offset + len(data)
+            else:
+                failed.append((offset, data))
+            self.progress(offset + len(data), total)
+
+        def send(statement):
+            return comms.send(statement)
+
+        for offset, data in failed:
+            self.write_chunk(offset, data, send, comms.interrupt)
+        self.checkpoint = fh.tell()
 
+    def write_chunk(self, offset, data, send, resync):
+        """
+        Send a chunk, retransmitting it if the device couldn't verify it.
+
+        After a timeout, ``resync`` is called to stop whatever the device is
+        doing and get back to a prompt before the chunk is sent again. Any
+        other error on the device is raised.
+        """
+        for attempt in range(self.retries):
+            try:
+                output = send(self.statement(offset, data))
+            except Timeout:
+                resync()
+                continue
+            if 'Traceback' in output:
+                raise ValueError(output)
+            if self.verified(output):
+                return
+        raise ValueError('Could not verify data at offset {}'.format(offset))
+
+    def verified(self, output):
+        return 'CRC' not in output and 'Traceback' not in output
+
+    def statement(self, offset, data):
+        """
+        Build the statement which writes (and verifies) a chunk of data.
+        """
+        crc = binascii.crc32(data) & 0xffffffff if self.verify else None
+        statement = b'_fhw(' + encode_chunk(data, self.encoding) + (
+            ', {}, {})'.format(crc, offset).encode())
+        self.wire_bytes += len(statement)
+        return statement
+
+    def progress(self, sent, total):
+        amount = sent / total
+        # Measured in bytes of the original file, not the (possibly
+        # compressed) data which was sent.
+        done = amount * self.size
+        elapsed = time.time() - self.started
+        if elapsed:
+            self.bytes_per_second = done / elapsed
+        if done:
+            self.overhead = self.wire_bytes / done
+        self.update(amount)
+
+
+class BatchUploader(object):
+    """
+    Upload several files using a single device session.
+
+    Remote directories are created as needed and files are sent smallest
+    first, with ``main.py`` and ``boot.py`` last.
+
+    Pass ``comms`` when calling to use a session other than the terminal's
+    (which may be left in the raw REPL).
+
+    Arguments:
+        files: list of (local path, remote name) tuples
+        dirs: remote directories to create (defaults to the parent
+            directories of the files)
+
+    Attributes:
+        current (Uploader): the file being uploaded
+        bytes_per_second (float): effective upload rate across the batch
+    """
+
+    def __init__(self, files, update_func=None, dirs=None, **kwargs):
+        self.files = sorted(files, key=lambda file: (
+            posixpath.basename(file[1]) in ('main.py', 'boot.py'),
+            os.path.getsize(file[0])))
+        if dirs is None:
+            dirs = set()
+            for path, name in self.files:
+                name = posixpath.dirname(name)
+                while name not in ('', '/'):
+                    dirs.add(name)
+                    name = posixpath.dirname(name)
+        self.dirs = sorted(dirs)
+        self.update_func = update_func
+        self.uploader_kwargs = kwargs
+        self.current = None
+        self.bytes_per_second = None
+
+    def update(self, amount):
+        if self.update_func:
+            self.update_func(amount)
+
+    def __call__(self, terminal, comms=None):
+        if comms:
+            return self.upload(terminal, comms)
+        comms = terminal.comms
+        try:
+            return self.upload(terminal, comms)
+        finally:
+            comms.exit_raw()
+
+    def upload(self, terminal, comms):
+        if not comms.raw:
+            comms.enter_raw()
+        if self.dirs:
+            comms.raw_exec(MKDIRS % self.dirs)
+        total = float(sum(os.path.getsize(path) for path, _ in self.files))
+        started = time.time()
+        done = 0
+
+        def progress(amount):
+            sent = done + amount * self.current.size
+            elapsed = time.time() - started
+            if elapsed:
+                self.bytes_per_second = sent / elapsed
+            self.update(sent / total if total else amount)
+
+        for path, name in self.files:
+            self.current = Uploader(
+                path, progress, remote_name=name, **self.uploader_kwargs)
+            self.current(terminal, comms)
+            done += self.current.size
         return True
 
 
+def upload_files(py_browser, objs):
+    """
+    Return the (local path, remote name) of each file to upload for the
+    selected browser items, including the matching files of directories.
+    """
+    files = []
+    for obj in objs:
+        if not obj.container:
+            files.append((obj.name, os.path.basename(obj.name)))
+            continue
+        base = os.path.dirname(os.path.normpath(obj.name))
+        for root, dirnames, filenames in os.walk(obj.name):
+            for filename in sorted(filenames):
+                path = os.path.join(root, filename)
+                if py_browser.file_match(path):
+                    name = os.path.relpath(path, base).replace(os.sep, '/')
+                    files.append((path, name))
+    return files
+
+
 def browse(terminal):
     window = curses.newwin(*terminal.window.getmaxyx())
     window.keypad(1)
@@ -61,38 +512,87 @@ def browse(terminal):
     py_browser = browser.PyBrowser()
     action, obj = py_browser.run(window)
     if action == 'SELECT':
+        files = upload_files(py_browser, py_browser.marked or [obj])
         width = terminal.window.getmaxyx()[1] - 8
         dialog = curses.newwin(4, width, 3, 4)
         dialog.border()
         width -= 4
-        dialog.addstr(1, 3, 'Uploading {}...'.format(obj.name))
 
         def progress(amount):
+            dialog.addstr(1, 3, pad('Uploading {}...'.format(
+                upload.current.name), width - 16)[:width - 16])
             dialog.addstr(2, 3, '#' * int(width * amount))
+            if upload.bytes_per_second:
+                dialog.addstr(1, width - 14, '{:>8.0f} B/s'.format(
+                    upload.bytes_per_second))
             dialog.refresh()
 
         panel = curses.panel.new_panel(dialog)
         panel.top()
         dialog.refresh()
-        upload = Uploader(obj.name, progress)
+        # Open the cache before changing the device, so it's updated in
+        # place rather than failing its fingerprint check.
+        comms = terminal.comms
+        cache = DeviceCache.open(comms)
+        upload = BatchUploader(files, progress)
         upload(terminal)
-        if os.path.basename(obj.name) in ('main.py', 'boot.py'):
+        if cache:
+            comms.import_module('os')
+            cwd = comms.json('os.getcwd()')
+            for path, name in files:
+                cache.uploaded(posixpath.join(cwd, name), path)
+            cache.save()
+        if any(posixpath.basename(name) in ('main.py', 'boot.py')
+               for _, name in files):
             terminal.tx(b'\x03\x04')
         return True
 
 
+def install_agent(terminal, path=agent.PATH):
+    """
+    Install (or update) the device side helper module.
+    """
+    fd, local_path = tempfile.mkstemp(suffix='.py')
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(agent.SOURCE)
+        BatchUploader([(local_path, path)])(terminal)
+    finally:
+        os.remove(local_path)
+    comms = terminal.comms
+    # Forget any older version imported earlier in the session.
+    if agent.NAME in comms.imports:
+        comms.imports.remove(agent.NAME)
+    comms.import_module('sys')
+    comms.send('sys.modules.pop(%r, None)' % agent.NAME)
+    comms.agent_version = agent.VERSION
+    return True
+
+
+def scrollback(terminal):
+    window = curses.newwin(*terminal.window.getmaxyx())
+    window.keypad(1)
+    curses.panel.new_panel(window)
+    viewer = Viewer(terminal.scrollback, [
+        line.rstrip() for line in terminal.screen.display])
+    viewer.run(window)
+    return True
+
+
 def reset(terminal, hard=True):
     if hard:
-        comms = Comms(terminal)
-        comms.import_module('machine')
-        comms.send('machine.reset()')
+        comms = terminal.comms
+        comms.interrupt()
+        comms.import_module('machine', silent=False)
+        comms.send('machine.reset()', silent=False)
     else:
         terminal.tx(b'\x03\x04')
     return True
 
 
 def remote(terminal):
-    comms = Comms(terminal, silent=True)
+    comms = terminal.comms
+    comms.interrupt()
     window = curses.newwin(*terminal.window.getmaxyx())
     window.keypad(1)
     curses.panel.new_panel(window)
@@ -116,6 +616,8 @@ def remote(terminal):
                     comms.send('os.chdir("/")')
                     cwd = '/'
                 comms.send('os.remove(%r)' % obj.name)
+                if upy_browser.cache:
+                    upy_browser.cache.removed(obj.name)
             continue
         elif action == 'SELECT':
             if obj.container:
@@ -123,3 +625,5 @@ def remote(terminal):
                 cwd = obj.name
                 continue
         break
+    if upy_browser.cache:
+        upy_browser.cache.save()
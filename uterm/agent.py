@@ -0,0 +1,224 @@
+"""
+The optional device side helper module.
+
+Once installed (with ``uterm agent``), uterm calls the helper's short
+functions instead of sending the source of common operations, which the
+device would otherwise have to compile every time. When the helper isn't
+installed, or is out of date, uterm falls back to sending the source.
+"""
+from __future__ import unicode_literals
+
+# Bump whenever SOURCE changes, so older installs are ignored.
+VERSION = 6
+NAME = '_uterm'
+PATH = '/lib/_uterm.py'
+
+# Directory listing helpers, which are also sent on their own (see
+# :func:`tree_helper`) when the helper module isn't installed.
+LISTING = '''\
+def _join(d, n):
+    return (d + '/' if d and d[-1] != '/' else d) + n
+
+
+def stat(p):
+    try:
+        s = os.stat(p)
+    except OSError:
+        return None
+    return [s[0] & 0x4000 != 0, s[6], s[8]]
+
+
+def ls(d):
+    # An empty path is the current directory.
+    try:
+        # Types come with the names, saving a stat of each directory.
+        es = [(e[0], e[1] == 0x4000) for e in os.ilistdir(d or '.')]
+    except AttributeError:
+        es = [(n, None) for n in os.listdir(d or '.')]
+    r = []
+    for n, t in es:
+        s = stat(_join(d, n)) or [bool(t), 0, 0]
+        if t is not None:
+            s[0] = t
+        r.append([n] + s)
+    return r
+
+
+def tree(d, depth=0):
+    try:
+        r = {d: ls(d)}
+    except OSError:
+        return {d: None}
+    if depth:
+        for n, isdir, size, mtime in r[d]:
+            if isdir:
+                r.update(tree(_join(d, n), depth - 1))
+    return r
+
+
+def walk(d, depth=-1):
+    r = {}
+    for n, isdir, size, mtime in ls(d):
+        p = _join(d, n)
+        r[p] = isdir
+        if isdir and depth:
+            r.update(walk(p, depth - 1))
+    return r
+
+
+def fingerprint(d, r=None):
+    r = r or [0, 0, 0, 0]
+    for n, isdir, size, mtime in ls(d):
+        r[0] += 1
+        r[1] += size
+        r[2] += mtime
+        r[3] = (r[3] + hash(n)) & 0xffffff
+        if isdir:
+            fingerprint(_join(d, n), r)
+    return r
+'''
+
+SOURCE = '''\
+import os, binascii, hashlib
+VERSION = %d
+
+
+%s
+
+def file_hash(p):
+    h = hashlib.sha256()
+    with open(p, 'rb') as f:
+        while True:
+            b = f.read(512)
+            if not b:
+                break
+            h.update(b)
+    return binascii.hexlify(h.digest()).decode()
+
+
+def hashes(d):
+    try:
+        r = walk(d)
+    except OSError:
+        return {}
+    for p in r:
+        r[p] = None if r[p] else file_hash(p)
+    r[d] = None
+    return r
+
+
+def crcs(p, block):
+    r = []
+    try:
+        with open(p, 'rb') as f:
+            o = c = 0
+            while True:
+                b = f.read(block)
+                if not b:
+                    break
+                o += len(b)
+                c = binascii.crc32(b, c)
+                r.append([o, c & 0xffffffff])
+    except OSError:
+        pass
+    return r
+
+
+def read(p, offset, size):
+    with open(p, 'rb') as f:
+        f.seek(offset)
+        return binascii.b2a_base64(f.read(size)).decode().strip()
+
+
+class Writer:
+
+    def __init__(self, p, mode):
+        self.f = open(p, mode)
+
+    def __call__(self, d, c, o):
+        if c is None or (binascii.crc32(d) & 0xffffffff) == c:
+            self.f.seek(o)
+            self.f.write(d)
+        else:
+            print('CRC')
+
+    def close(self):
+        self.f.close()
+
+
+def rmtree(p):
+    if stat(p)[0]:
+        for n in os.listdir(p):
+            rmtree(_join(p, n))
+        os.rmdir(p)
+    else:
+        os.remove(p)
+''' % (VERSION, LISTING)
+
+
+def installed(comms):
+    """
+    Check whether the current version of the helper is installed on the
+    device, importing it if so.
+
+    The installed version is only asked for once per session.
+    """
+    if comms.agent_version is None:
+        version = comms.json_batch(['__import__(%r).VERSION' % NAME])[0]
+        comms.agent_version = 0 if isinstance(version, Exception) else version
+    if comms.agent_version != VERSION:
+        return False
+    comms.import_module(NAME)
+    return True
+
+
+def call(function, *args):
+    """
+    Return device side source which prints the JSON result of calling one of
+    the helper's functions.
+    """
+    return 'import json\nprint(json.dumps(%s.%s(%s)))' % (
+        NAME, function, ', '.join(repr(arg) for arg in args))
+
+
+def tree_helper():
+    """
+    Return device side source defining ``_ut_t``, a namespace holding the
+    listing helpers, for when the helper module isn't installed.
+    """
+    return "import os\n_ut_t = {'os': os}\nexec(%r, _ut_t)" % LISTING
+
+
+def listing(comms, function, *args):
+    """
+    Evaluate one of the listing helpers on the device, through the helper
+    module if it's installed.
+    """
+    arguments = ', '.join(repr(arg) for arg in args)
+    if installed(comms):
+        command = '%s.%s(%s)' % (NAME, function, arguments)
+    else:
+        comms.define('_ut_t', tree_helper())
+        command = '_ut_t[%r](%s)' % (function, arguments)
+    return comms.json(command)
+
+
+def tree(comms, path, depth=0):
+    """
+    List ``path`` and its subdirectories down to ``depth`` levels in one
+    round trip.
+
+    Returns:
+        A dict of directory path to a list of ``[name, isdir, size, mtime]``
+        entries, or None for directories which couldn't be listed.
+    """
+    return listing(comms, 'tree', path, depth) or {path: None}
+
+
+def fingerprint(comms, path):
+    """
+    Summarise every entry below ``path`` (their count, total size, total
+    mtime and a hash of their names), to tell whether anything changed
+    without listing it all.
+    """
+    return listing(comms, 'fingerprint', path)
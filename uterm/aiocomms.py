@@ -0,0 +1,199 @@
+"""
+An asyncio interface to a device session (Python 3.5+ only).
+
+Requests are queued and run in order over the one friendly REPL, each
+returning a future, so callers can keep doing other work (or stay
+responsive to keys) while waiting on the device.
+"""
+import asyncio
+import collections
+import json
+import time
+
+from .comms import TRY, ReadUntil, Timeout
+
+
+class AsyncComms(object):
+    """
+    Queue friendly REPL requests on a :class:`uterm.comms.Comms` session.
+
+    Incoming data is read with ``loop.add_reader`` on the terminal's file
+    descriptor while requests are pending (polled when the terminal has no
+    file descriptor), and the reader is removed again once the queue is
+    empty so the synchronous session can use the port in between.
+    """
+
+    def __init__(self, comms, loop=None):
+        self.comms = comms
+        self.terminal = comms.terminal
+        self.loop = loop or asyncio.get_event_loop()
+        self.queue = collections.deque()
+        self.worker = None
+        # Resolved when new data arrives.
+        self.waiter = None
+        self.fd = None
+
+    def send(self, text, timeout=None):
+        """
+        Queue a statement for the friendly REPL.
+
+        Returns:
+            A future of the statement's output (without the echoed
+            statement). It raises ``ValueError`` if nothing arrived from the
+            device for ``timeout`` seconds (sized from the session's link
+            statistics by default).
+        """
+        if hasattr(text, 'encode'):
+            text = text.encode()
+        future = self.loop.create_future()
+        self.queue.append((text, timeout, future))
+        if self.worker is None or self.worker.done():
+            self.worker = self.loop.create_task(self.run())
+        return future
+
+    def import_module(self, name):
+        """
+        Queue an import (unless it's already been imported this session).
+
+        Returns:
+            A future which is done once the module is imported.
+        """
+        if name in self.comms.imports:
+            future = self.loop.create_future()
+            future.set_result('')
+            return future
+        return self.remember(name, self.send('import %s' % name))
+
+    def remember(self, name, future):
+        """
+        Add to the session's imports once the statement defining ``name``
+        succeeds.
+        """
+        def done(future):
+            if future.cancelled() or future.exception() is not None:
+                return
+            if ('Traceback' not in future.result() and
+                    name not in self.comms.imports):
+                self.comms.imports.append(name)
+
+        future.add_done_callback(done)
+        return future
+
+    def json(self, command):
+        """
+        Queue the evaluation of an expression.
+
+        Returns:
+            A future of the decoded JSON result (``None`` if the expression
+            couldn't be evaluated).
+        """
+        self.import_module('json')
+        return self.loop.create_task(self._loads(self.send(
+            'print(json.dumps(%s))' % command.strip())))
+
+    def json_batch(self, expressions):
+        """
+        Queue the evaluation of several expressions in a single round trip.
+
+        Returns:
+            A future of the results, as for
+            :meth:`uterm.comms.Comms.json_batch`.
+        """
+        if '_ut' not in self.comms.imports:
+            self.remember('_ut', self.send('exec(%r)' % TRY))
+        futures = [
+            self.json(command)
+            for command in self.comms.batch_commands(expressions)]
+        return self.loop.create_task(self._results(futures, expressions))
+
+    async def _loads(self, future):
+        try:
+            return json.loads(await future)
+        except ValueError:
+            pass
+
+    async def _results(self, futures, expressions):
+        batches = [await future for future in futures]
+        return self.comms.batch_results(batches, expressions)
+
+    async def run(self):
+        """
+        Run queued requests in order until the queue is empty.
+        """
+        self.start_reading()
+        try:
+            while self.queue:
+                text, timeout, future = self.queue.popleft()
+                if future.cancelled():
+                    continue
+                if timeout is None:
+                    timeout = self.comms.stats.timeout(
+                        len(text), code=True)
+                try:
+                    self.terminal.tx(text + b'\r')
+                    self.comms.stats.sent()
+                    response = await self.read_until(b'>>> ', timeout)
+                except Exception as e:
+                    if not future.cancelled():
+                        future.set_exception(e)
+                    continue
+                if not future.cancelled():
+                    future.set_result(
+                        self.comms.strip_echo(text, response[:-4]))
+        finally:
+            self.stop_reading()
+
+    def start_reading(self):
+        try:
+            self.fd = self.terminal.fileno()
+        except AttributeError:
+            # No file descriptor to watch, so poll instead.
+            self.fd = None
+            return
+        self.loop.add_reader(self.fd, self.readable)
+
+    def stop_reading(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            self.fd = None
+
+    def readable(self):
+        if self.comms.fill() and self.waiter and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def wait(self, deadline):
+        """
+        Wait until there is incoming data.
+
+        Raises:
+            Timeout: nothing arrived before the deadline.
+        """
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise Timeout('Timeout')
+        if self.fd is None:
+            await asyncio.sleep(min(remaining, 0.001))
+            self.comms.fill()
+            return
+        self.waiter = self.loop.create_future()
+        try:
+            await asyncio.wait_for(self.waiter, remaining)
+        except asyncio.TimeoutError:
+            raise Timeout('Timeout')
+        finally:
+            self.waiter = None
+
+    async def read_until(self, ending, timeout):
+        """
+        Read from the device up to and including ``ending``, waiting up to
+        ``timeout`` seconds for each part of it.
+        """
+        comms = self.comms
+        until = ReadUntil(comms, ending, timeout)
+        while True:
+            data = until.take()
+            if data is not None:
+                return data
+            received = len(comms.buffer)
+            await self.wait(until.deadline)
+            until.received(len(comms.buffer) - received)
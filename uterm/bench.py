@@ -0,0 +1,190 @@
+"""
+Benchmarks for comparing uterm's transfer strategies.
+
+Benchmarks which need a device are run with ``uterm bench``, the rest with
+``python -m uterm.bench``.
+"""
+from __future__ import print_function, unicode_literals
+import io
+import time
+import timeit
+
+import pyte
+
+from .actions import Uploader
+from .comms import Comms
+from .terminal import Terminal
+
+
+# Device file the benchmark uploads to (removed afterwards), so the
+# device's own copy of the file is left alone.
+SCRATCH_NAME = '_uterm_bench'
+
+
+def upload(terminal, path, repeat=3):
+    """
+    Time plain and compressed uploads of a local file to the device.
+
+    Returns:
+        List of (name, seconds, overhead) tuples using the best wall time of
+        ``repeat`` uploads for each strategy.
+    """
+    results = []
+    try:
+        for name, compress in (('plain', False), ('compressed', True)):
+            best = None
+            for i in range(repeat):
+                uploader = Uploader(
+                    path, remote_name=SCRATCH_NAME, compress=compress)
+                start = time.time()
+                uploader(terminal)
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            results.append((name, best, uploader.overhead))
+    finally:
+        comms = terminal.comms
+        comms.import_module('os')
+        # Including the temporary files of an interrupted upload.
+        temp_name = '_' + SCRATCH_NAME
+        for name in (SCRATCH_NAME, temp_name, temp_name + '.z'):
+            comms.send(
+                'if %r in os.listdir(): os.remove(%r)\r' % (name, name))
+    return results
+
+
+class EchoTerminal(object):
+    """
+    Terminal stand-in which instantly answers every statement like the
+    friendly REPL, with a fixed output.
+    """
+
+    def __init__(self, output=b''):
+        self.output = output
+        self.pending = b''
+
+    def tx(self, data):
+        self.pending = data.rstrip(b'\r') + b'\r\n' + self.output + b'>>> '
+
+    write = tx
+
+    def wait(self, timeout):
+        return bool(self.pending)
+
+    def rx(self, silent=False):
+        data, self.pending = self.pending, b''
+        return data
+
+
+def screen_send(terminal, text):
+    """
+    The original ``Comms.send``, which ran every response through a pyte
+    screen, for comparison.
+    """
+    text += b'\r'
+    terminal.tx(text)
+    stream = pyte.ByteStream()
+    width = 1000
+    screen = pyte.Screen(width, 10)
+    stream.attach(screen)
+    incoming = io.BytesIO()
+    while True:
+        data = terminal.rx()
+        if not data:
+            continue
+        stream.feed(data)
+        incoming.write(data)
+        incoming.seek(-4, io.SEEK_END)
+        if incoming.read() == b'>>> ':
+            output = io.StringIO()
+            for line in screen.display:
+                line = line.strip()
+                output.write(line)
+                if len(line) < width:
+                    output.write(u'\n')
+            return output.getvalue().rstrip()[:-3]
+
+
+def send_overhead(calls=1000, output=b'[1, 2, 3]\r\n'):
+    """
+    Measure the per-call overhead of parsing friendly REPL responses.
+
+    Returns:
+        Tuple of microseconds per call (before, after).
+    """
+    statement = b'print(json.dumps(x))'
+    before = timeit.timeit(
+        lambda: screen_send(EchoTerminal(output), statement), number=calls)
+    comms = Comms(EchoTerminal(output))
+    after = timeit.timeit(lambda: comms.send(statement), number=calls)
+    return before / calls * 1e6, after / calls * 1e6
+
+
+class FloodPort(object):
+    """
+    Port stand-in which always has more output waiting.
+    """
+    is_open = True
+
+    def __init__(self, chunk):
+        self.chunk = chunk
+
+    def inWaiting(self):
+        return len(self.chunk)
+
+    def read(self, size):
+        return self.chunk
+
+
+class NullWindow(object):
+    """
+    Curses window stand-in which counts the calls made to it.
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    def addstr(self, *args):
+        self.calls += 1
+
+    def move(self, *args):
+        self.calls += 1
+
+
+def render_throughput(frame_rate, size=1 << 20, width=80, height=24):
+    """
+    Measure how much device output the terminal can display, feeding it
+    lines in serial sized reads.
+
+    Returns:
+        Tuple of (bytes per second, curses calls).
+    """
+    chunk = (b'x' * 60 + b'\r\n') * 2
+    terminal = Terminal(FloodPort(chunk))
+    terminal.frame_rate = frame_rate
+    terminal.window = NullWindow()
+    terminal.screen = pyte.DiffScreen(width - 1, height)
+    terminal.screen_stream = pyte.ByteStream()
+    terminal.screen_stream.attach(terminal.screen)
+    start = time.time()
+    for i in range(size // len(chunk)):
+        terminal.rx()
+    terminal.render(force=True)
+    return size / (time.time() - start), terminal.window.calls
+
+
+def main():
+    for frame_rate in (None, Terminal.frame_rate):
+        rate, calls = render_throughput(frame_rate)
+        print('Rendering ({} frames/s): {:.0f} B/s, {} curses calls'.format(
+            frame_rate or 'uncapped', rate, calls))
+    for name, output in (
+            ('short', b'[1, 2, 3]\r\n'),
+            ('100 lines', (b'x' * 70 + b'\r\n') * 100)):
+        before, after = send_overhead(output=output)
+        print('Comms.send ({}): {:.0f}us per call before, {:.0f}us after'
+              .format(name, before, after))
+
+
+if __name__ == '__main__':
+    main()
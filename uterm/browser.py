@@ -1,15 +1,161 @@
 from __future__ import unicode_literals
+import heapq
 import os
+import posixpath
+import threading
 import curses
 from fnmatch import fnmatch
+try:
+    from os import scandir
+except ImportError:  # Python 2
+    scandir = None
+
+from . import agent
+from .cache import DeviceCache
 
 ESC = 27
+BACKSPACE = (curses.KEY_BACKSPACE, 127, 8)
 
 
 def pad(data, width):
     return data + ' ' * (width - len(data))
 
 
+def fuzzy_points(path, index, position, basename):
+    """
+    The points for a query character found at ``index`` of ``path``,
+    searching from ``position`` (just after the previous character, or 0
+    for the first).
+    """
+    points = 0
+    if index and index == position:
+        points += 5
+    if index == 0 or path[index - 1] in '/_-. ':
+        points += 3
+    if index >= basename:
+        points += 2
+    return points
+
+
+def fuzzy_score(query, path):
+    """
+    Score how well ``path`` matches the characters of ``query`` (in order,
+    both lowercase), favouring consecutive characters, the starts of words
+    and the basename. Returns None if it doesn't match.
+    """
+    basename = path.rfind('/') + 1
+    # Prefer shorter paths.
+    score = -len(path) / 1000.0
+    position = 0
+    for char in query:
+        index = path.find(char, position)
+        if index < 0:
+            return None
+        score += fuzzy_points(path, index, position, basename)
+        position = index + 1
+    return score
+
+
+class PathIndex(object):
+    """
+    Paths to search with a fuzzy query.
+
+    Each query character is matched at its earliest position after the
+    previous one, so a query which extends the previous one continues each
+    match from where it stopped, adding to its score. The state for each
+    shorter query is kept, so deleting characters costs nothing.
+
+    A keystroke makes at most ``budget`` character checks, taking the
+    shortest paths first (they score best), which keeps it within a frame
+    however many paths there are. The rest keep their progress and are
+    caught up by later keystrokes as the query narrows the matches, so
+    while a query is too vague for that the best matches are picked from
+    the shortest paths.
+
+    Attributes:
+        matches (list): indexes of the paths matching the current query,
+            the first ``checked`` of them fully
+    """
+    budget = 10000
+
+    def __init__(self, paths):
+        self.paths = [path for path, _ in paths]
+        self.containers = [container for _, container in paths]
+        self.lower = [path.lower().replace(os.sep, '/') for path in self.paths]
+        self.basenames = [path.rfind('/') + 1 for path in self.lower]
+        self.query = ''
+        self.matches = sorted(
+            range(len(self.paths)), key=lambda i: len(self.lower[i]))
+        # How much of the query each match has matched, where it continues
+        # from and its score so far.
+        self.consumed = [0] * len(self.paths)
+        self.positions = [0] * len(self.paths)
+        self.scores = [-len(self.lower[i]) / 1000.0 for i in self.matches]
+        self.checked = len(self.paths)
+        # The states of the shorter queries.
+        self.history = []
+
+    def __len__(self):
+        return len(self.paths)
+
+    def state(self):
+        return (self.query, self.matches, self.consumed, self.positions,
+                self.scores, self.checked)
+
+    def narrow(self, query):
+        """
+        Catch the matches up with ``query`` (which extends the current
+        query) until the budget runs out, dropping those which no longer
+        match.
+        """
+        self.history.append(self.state())
+        lower, basenames = self.lower, self.basenames
+        matches, consumed, positions, scores = [], [], [], []
+        budget = self.budget
+        count = 0
+        for i, done, position, score in zip(
+                self.matches, self.consumed, self.positions, self.scores):
+            if budget <= 0:
+                break
+            count += 1
+            path = lower[i]
+            for char in query[done:]:
+                budget -= 1
+                index = path.find(char, position)
+                if index < 0:
+                    break
+                score += fuzzy_points(path, index, position, basenames[i])
+                position = index + 1
+            else:
+                matches.append(i)
+                consumed.append(len(query))
+                positions.append(position)
+                scores.append(score)
+        self.query = query
+        self.checked = len(matches)
+        self.matches = matches + self.matches[count:]
+        self.consumed = consumed + self.consumed[count:]
+        self.positions = positions + self.positions[count:]
+        self.scores = scores + self.scores[count:]
+
+    def search(self, query, limit):
+        """
+        Return the (path, container) of the best matches, best first.
+        """
+        query = query.lower()
+        while not query.startswith(self.query):
+            (self.query, self.matches, self.consumed, self.positions,
+             self.scores, self.checked) = self.history.pop()
+        if query != self.query:
+            self.narrow(query)
+        if query:
+            best = [self.matches[j] for j in heapq.nlargest(
+                limit, range(self.checked), key=self.scores.__getitem__)]
+        else:
+            best = range(min(limit, len(self.paths)))
+        return [(self.paths[i], self.containers[i]) for i in best]
+
+
 class File(object):
     """
     A file / directory node in the filesystem.
@@ -27,8 +173,9 @@ class File(object):
         self._nice_name = nice_name
 
     def render(self, depth, width):
-        return pad('%s%s %s' % (' ' * 2 * depth, self.icon(),
-                                self.nice_name), width)
+        mark = ' *' if self in self.factory.marked else ''
+        return pad('%s%s %s%s' % (' ' * 2 * depth, self.icon(),
+                                  self.nice_name, mark), width)
 
     @property
     def nice_name(self):
@@ -99,11 +246,24 @@ class Dir(File):
 
     @expanded.setter
     def expanded(self, value):
-        self._expanded = value and self.children()
+        # Empty directories can't be expanded, unless still being listed.
+        self._expanded = value and (
+            self.children() or self.factory.pending(self.name))
 
     def collapse(self):
         self.expanded = False
 
+    def refresh(self):
+        """
+        List the directory again, keeping the existing child items.
+        """
+        old = dict((kid.name, kid) for kid in self.kids or ())
+        self._kidnames = self.factory.child_names(self.name)
+        if self.kids is not None:
+            self.kids = [
+                old.get(name) or self.factory.item(name)
+                for name in self._kidnames or ()]
+
     def traverse(self):
         """
         Traverses expanded child filesystem nodes
@@ -127,15 +287,26 @@ class BrowserBase(object):
         dir_class (type): Type of directories
         file_class (type): Type of files
         initial_index (int):
+        multiple (bool): Whether items can be marked (with space) to select
+            more than one
+        marked (:obj:`list` of :obj:`File`): marked items
     """
     dir_class = Dir
     file_class = File
     initial_index = 0
     return_container = True
+    multiple = False
     base_name = '.'
+    # Whether directory listings are still arriving (see update).
+    loading = False
 
     def __init__(self, name=None, root_name=None):
         self.root_name = root_name
+        self.marked = []
+        self.path_index = None
+        # The items of search results, by path.
+        self.found = {}
+        self.results = []
         self.reset(name)
 
     def reset(self, name=None):
@@ -143,6 +314,9 @@ class BrowserBase(object):
             name = self.base.name if hasattr(self, 'base') else self.base_name
         self.base = self.item(name, nice_name=self.root_name)
         self.base.expanded = True
+        # The (File, depth) of each visible row, kept up to date as
+        # directories are expanded and collapsed.
+        self.rows = list(self.base.traverse())
 
     def item(self, name, *args, **kwargs):
         """
@@ -157,48 +331,155 @@ class BrowserBase(object):
             obj_class = self.file_class
         return obj_class(name, factory=self, *args, **kwargs)
 
+    def expand(self, index, expanded=True):
+        """
+        Expand or collapse the item on a row, splicing its descendants into
+        (or out of) the visible rows.
+        """
+        obj, depth = self.rows[index]
+        end = index + 1
+        while end < len(self.rows) and self.rows[end][1] > depth:
+            end += 1
+        obj.expanded = expanded
+        self.rows[index + 1:end] = [
+            (kid, kid_depth + depth)
+            for kid, kid_depth in obj.traverse()][1:]
+
+    def draw(self, stdscr, curidx, rows, query=None):
+        """
+        Draw the rows in view, without clearing the rest of the screen.
+        """
+        height = curses.LINES - 1
+        offset = max(0, curidx - curses.LINES + 3)
+        for y in range(height):
+            line = offset + y
+            if line >= len(rows):
+                stdscr.move(y, 0)
+                stdscr.clrtoeol()
+                continue
+            if line == curidx:
+                stdscr.attrset(curses.color_pair(1) | curses.A_BOLD)
+            else:
+                stdscr.attrset(curses.color_pair(0))
+            data, depth = rows[line]
+            stdscr.addstr(
+                y, 0, data.render(depth, curses.COLS)[:curses.COLS])
+        if query is not None:
+            stdscr.attrset(curses.A_BOLD)
+            stdscr.addstr(height, 0, ('/' + query)[:curses.COLS - 1])
+            stdscr.clrtoeol()
+        stdscr.refresh()
+
     def run(self, stdscr):
         """
         Draws the browser UI on the screen
+
+        ``/`` starts a search, which lists the paths fuzzily matching what's
+        typed (escape returns to the tree).
         """
+        curses.init_pair(1, curses.COLOR_WHITE, curses.COLOR_BLUE)
+        stdscr.clear()
         curidx = self.initial_index
+        query = None
         while True:
-            stdscr.clear()
-            curses.init_pair(1, curses.COLOR_WHITE, curses.COLOR_BLUE)
-            offset = max(0, curidx - curses.LINES + 3)
-            current_obj = self.base
-            for line, (data, depth) in enumerate(self.base.traverse()):
-                if line == curidx:
-                    stdscr.attrset(curses.color_pair(1) | curses.A_BOLD)
-                    current_obj = data
-                else:
-                    stdscr.attrset(curses.color_pair(0))
-                if 0 <= line - offset < curses.LINES - 1:
-                    stdscr.addstr(
-                        line - offset, 0, data.render(depth, curses.COLS))
-            stdscr.refresh()
+            self.update()
+            rows = self.rows if query is None else self.results
+            curidx = curidx % len(rows) if rows else 0
+            self.draw(stdscr, curidx, rows, query)
+            current_obj = rows[curidx][0] if rows else self.base
+            # Wake up to show listings as they arrive.
+            stdscr.timeout(100 if self.loading else -1)
             ch = stdscr.getch()
-            if ch == curses.KEY_UP:
+            if query is None and ch == ord('/'):
+                query = ''
+                self.search(query)
+                curidx = 0
+            elif query is not None and ch == ESC:
+                query = None
+                stdscr.move(curses.LINES - 1, 0)
+                stdscr.clrtoeol()
+            elif query is not None and (ch in BACKSPACE or 32 < ch < 127):
+                # Space is left for marking results.
+                query = query[:-1] if ch in BACKSPACE else query + chr(ch)
+                self.search(query)
+                curidx = 0
+            elif ch == curses.KEY_UP:
                 curidx -= 1
             elif ch == curses.KEY_DOWN:
                 curidx += 1
             elif ch == curses.KEY_PPAGE:
                 curidx -= max(0, curses.LINES)
             elif ch == curses.KEY_NPAGE:
-                curidx += min(line - 1, curses.LINES)
-            elif ch == curses.KEY_RIGHT:
-                current_obj.expanded = True
-            elif ch == curses.KEY_LEFT:
-                current_obj.expanded = False
+                curidx += min(len(rows) - 2, curses.LINES)
+            elif ch == curses.KEY_RIGHT and query is None:
+                self.expand(curidx)
+            elif ch == curses.KEY_LEFT and query is None:
+                self.expand(curidx, False)
             elif ch == ESC:
                 return ('CANCEL', current_obj)
             elif ch == curses.KEY_DC:  # Del
                 return ('DELETE', current_obj)
+            elif ch == ord(' ') and self.multiple:
+                if current_obj in self.marked:
+                    self.marked.remove(current_obj)
+                else:
+                    self.marked.append(current_obj)
             elif ch == ord('\n'):
-                if self.return_container or not current_obj.container:
+                if (self.marked or self.return_container or
+                        not current_obj.container):
                     return ('SELECT', current_obj)
-                current_obj.expanded = not current_obj.expanded
-            curidx %= line + 1
+                if query is None:
+                    self.expand(curidx, not current_obj.expanded)
+
+    def all_paths(self):
+        """
+        Return the (path, container) of everything below the base, to
+        search.
+        """
+        paths = []
+        pending = [self.base.name]
+        while pending:
+            for path in self.child_names(pending.pop()) or ():
+                container = self.is_container(path)
+                paths.append((path, container))
+                if container:
+                    pending.append(path)
+        return paths
+
+    def search(self, query):
+        """
+        Fill ``results`` with the best matches for a query, indexing the
+        paths first if this is the session's first search.
+        """
+        if self.path_index is None:
+            self.path_index = PathIndex(self.all_paths())
+        prefix = self.base.name.rstrip('/') + '/'
+        self.results = []
+        for path, container in self.path_index.search(
+                query, curses.LINES - 1):
+            if path not in self.found:
+                nice_name = path.replace(os.sep, '/')
+                if nice_name.startswith(prefix):
+                    nice_name = nice_name[len(prefix):]
+                obj_class = self.dir_class if container else self.file_class
+                self.found[path] = obj_class(
+                    path, factory=self, nice_name=nice_name)
+            self.results.append((self.found[path], 0))
+
+    def pending(self, name):
+        """
+        Whether a directory's listing is still arriving.
+        """
+        return False
+
+    def update(self):
+        """
+        Show any directory listings which have arrived since the last call.
+
+        Returns:
+            bool: whether the rows changed
+        """
+        return False
 
     def child_names(self, name):
         paths = self.list_container(name)
@@ -221,23 +502,166 @@ class BrowserBase(object):
         return [self.item(child) for child in child_names]
 
 
+class ListdirEntry(object):
+    """
+    Stands in for ``os.DirEntry`` where ``os.scandir`` isn't available.
+    """
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._stat = None
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+
+class Scan(object):
+    """
+    List a directory on a worker thread, keeping each entry's
+    ``os.DirEntry`` (which caches its type and stat).
+
+    Attributes:
+        names (:obj:`list` of str): the entry names found so far
+        entries (dict): the entry for each name
+        error (Exception): why the directory couldn't be listed
+        done (threading.Event): set once the listing is complete
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+        self.entries = {}
+        self.error = None
+        self.done = threading.Event()
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        path = self.path or '.'
+        try:
+            if scandir is None:
+                entries = (
+                    ListdirEntry(self.path, name)
+                    for name in os.listdir(path))
+            else:
+                entries = scandir(path)
+            for entry in entries:
+                # Cache the type while still on the worker thread.
+                entry.is_dir()
+                self.entries[entry.name] = entry
+                self.names.append(entry.name)
+        except Exception as e:
+            self.error = e  # probably permission denied
+        finally:
+            self.done.set()
+
+
 class OSBrowser(BrowserBase):
+    """
+    Browse the local filesystem.
+
+    Directories are scanned on worker threads. A listing which takes longer
+    than ``scan_timeout`` seconds is shown as far as it's got, then filled
+    in as the rest arrives.
+    """
+
+    scan_timeout = 0.05
+
+    def __init__(self, *args, **kwargs):
+        self.scans = {}
+        # The (entry count, done) of each scan when it was last listed.
+        self.listed = {}
+        # Scans whose completion has been passed on to their parent.
+        self.finished = set()
+        super(OSBrowser, self).__init__(*args, **kwargs)
+
+    def scan(self, name):
+        if name not in self.scans:
+            self.scans[name] = Scan(name)
+            self.scans[name].done.wait(self.scan_timeout)
+        return self.scans[name]
+
+    def entry(self, name):
+        """
+        The scanned entry for a path, if its directory has been scanned.
+        """
+        scan = self.scans.get(os.path.dirname(name))
+        return scan and scan.entries.get(os.path.basename(name))
 
     def is_container(self, name):
+        entry = self.entry(name)
+        if entry is not None:
+            return entry.is_dir()
         return os.path.isdir(name)
 
     def list_container(self, name):
-        try:
-            return os.listdir(name)
-        except Exception:
-            return  # probably permission denied
+        scan = self.scan(name)
+        done = scan.done.is_set()
+        names = list(scan.names)
+        self.listed[name] = (len(names), done)
+        if scan.error is not None:
+            return
+        return names
+
+    def pending(self, name):
+        scan = self.scans.get(name)
+        return scan is not None and not scan.done.is_set()
+
+    @property
+    def loading(self):
+        return not all(scan.done.is_set() for scan in self.scans.values())
+
+    def update(self):
+        changed = set()
+        for name, scan in list(self.scans.items()):
+            if self.listed.get(name) != (
+                    len(scan.names), scan.done.is_set()):
+                changed.add(name)
+            if scan.done.is_set() and name not in self.finished:
+                # Subclasses may filter directories on their contents.
+                self.finished.add(name)
+                changed.add(os.path.dirname(name))
+        if not changed:
+            # Skip walking the rows, as this runs on every key.
+            return False
+        refresh = [
+            obj for obj, _ in self.rows
+            if obj.container and obj.name in changed and
+            hasattr(obj, '_kidnames')]
+        for obj in refresh:
+            obj.refresh()
+        if refresh:
+            self.rows = list(self.base.traverse())
+        return bool(refresh)
+
+    def all_paths(self):
+        paths = []
+        for root, dirnames, filenames in os.walk(self.base.name):
+            dirnames.sort()
+            paths.extend(
+                (os.path.join(root, name), True) for name in dirnames)
+            paths.extend(
+                (os.path.join(root, name), False) for name in sorted(filenames)
+                if self.file_match(name))
+        return paths
 
     @property
     def initial_index(self):
         index = 0
         latest = 0
         for i, child in enumerate(self.base.children()):
-            mtime = os.path.getmtime(child.name)
+            entry = self.entry(child.name) or ListdirEntry('', child.name)
+            try:
+                mtime = entry.stat().st_mtime
+            except OSError:
+                continue
             if mtime > latest:
                 latest = mtime
                 index = i + 1
@@ -245,31 +669,83 @@ class OSBrowser(BrowserBase):
 
 
 class PyBrowser(OSBrowser):
+    """
+    Pick Python files to upload, leaving out directories which turn out to
+    hold neither Python files nor subdirectories.
+    """
 
     return_container = False
+    multiple = True
 
     def file_match(self, name):
         return fnmatch(name, '*.py') or fnmatch(name, '*.mpy')
 
+    def child_names(self, name):
+        names = super(PyBrowser, self).child_names(name)
+        return names and [child for child in names if not self.empty(child)]
+
+    def empty(self, name):
+        scan = self.scans.get(name)
+        if scan is None or not scan.done.is_set() or scan.error:
+            return False
+        return not any(
+            entry.is_dir() or self.file_match(entry.name)
+            for entry in list(scan.entries.values()))
+
 
 class uPyBrowser(BrowserBase):
+    """
+    Browse the device's filesystem.
+
+    Each directory is listed (with the types, sizes and mtimes of its
+    entries) in a single round trip, along with its subdirectories down to
+    ``prefetch_depth`` levels. Listings are kept in the device's
+    :class:`~uterm.cache.DeviceCache`, so known directories open without
+    asking the device.
+    """
 
     base_name = '/'
+    prefetch_depth = 1
 
     def __init__(self, comms, *args, **kwargs):
         self.comms = comms
+        self.cache = DeviceCache.open(comms)
         super(uPyBrowser, self).__init__(*args, **kwargs)
 
     def reset(self, *args, **kwargs):
         self.listdir_cache = {}
+        self.container_cache = {}
+        # The (size, mtime) of each entry listed.
+        self.stat_cache = {}
         super(uPyBrowser, self).reset(*args, **kwargs)
 
+    def fetch(self, name):
+        if self.cache and name in self.cache.listings:
+            tree = {name: self.cache.listings[name]}
+        else:
+            tree = agent.tree(self.comms, name, self.prefetch_depth)
+            if self.cache:
+                self.cache.store_tree(tree)
+        for path, entries in tree.items():
+            self.container_cache.setdefault(path, entries is not None)
+            self.listdir_cache[path] = entries and [
+                entry[0] for entry in entries]
+            for entry_name, isdir, size, mtime in entries or ():
+                entry_path = posixpath.join(path, entry_name)
+                self.container_cache[entry_path] = isdir
+                self.stat_cache[entry_path] = (size, mtime)
+
+    def all_paths(self):
+        # One round trip, only made when first searching.
+        paths = agent.listing(self.comms, 'walk', self.base.name) or {}
+        return sorted(paths.items())
+
     def list_container(self, path):
-        self.comms.import_module('os')
-        return self.listdir_cache.setdefault(
-            path, self.comms.json('os.listdir(%s)' % repr(path)))
+        if path not in self.listdir_cache:
+            self.fetch(path)
+        return self.listdir_cache[path]
 
     def is_container(self, name):
-        if name.endswith('.py'):
-            return False
-        return isinstance(self.list_container(name), list)
+        if name not in self.container_cache:
+            self.fetch(name)
+        return self.container_cache[name]
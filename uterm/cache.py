@@ -0,0 +1,189 @@
+"""
+Remote filesystem metadata, remembered between sessions.
+"""
+from __future__ import unicode_literals
+import hashlib
+import io
+import json
+import os
+import posixpath
+
+from . import agent
+
+DIRECTORY = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or
+    os.path.join(os.path.expanduser('~'), '.cache'), 'uterm')
+
+# Device side expression for the device's unique id, as hex.
+DEVICE_ID = (
+    "__import__('binascii').hexlify("
+    "__import__('machine').unique_id()).decode()")
+
+
+def local_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(4096), b''):
+            h.update(data)
+    return h.hexdigest()
+
+
+def within(path, root):
+    return path == root or path.startswith(root.rstrip('/') + '/')
+
+
+class DeviceCache(object):
+    """
+    The listings and file hashes of a device, stored as JSON under its
+    ``machine.unique_id()``.
+
+    The cache is only trusted while the device's fingerprint (see
+    :func:`uterm.agent.fingerprint`) of everything below ``root`` matches
+    the one saved with it, so changes made by anything else throw it away.
+    uterm's own changes update it in place (:meth:`uploaded`,
+    :meth:`created` and :meth:`removed`), then :meth:`save` records the new
+    fingerprint.
+
+    Only absolute paths are cached.
+
+    Attributes:
+        listings (dict): directory path to a list of ``[name, isdir, size,
+            mtime]`` entries (None if it couldn't be listed)
+        hashes (dict): path to the sha256 of each file (None for
+            directories) below the roots in ``hashed``
+        hashed (list): directories whose whole tree is in ``hashes``
+    """
+    directory = DIRECTORY
+    root = '/'
+
+    def __init__(self, comms, device_id):
+        self.comms = comms
+        self.path = os.path.join(self.directory, device_id + '.json')
+        self.listings = {}
+        self.hashes = {}
+        self.hashed = []
+        self.load()
+
+    @classmethod
+    def open(cls, comms):
+        """
+        Return the cache for the connected device (looked up once per
+        session), or None if the device has no unique id.
+        """
+        if comms.device_cache is None:
+            device_id = comms.json_batch([DEVICE_ID])[0]
+            comms.device_cache = (
+                False if isinstance(device_id, Exception)
+                else cls(comms, device_id))
+        return comms.device_cache or None
+
+    def load(self):
+        try:
+            with io.open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if data.get('fingerprint') != agent.fingerprint(
+                self.comms, self.root):
+            return
+        self.listings = data['listings']
+        self.hashes = data['hashes']
+        self.hashed = data['hashed']
+
+    def save(self):
+        data = {
+            'fingerprint': agent.fingerprint(self.comms, self.root),
+            'listings': self.listings,
+            'hashes': self.hashes,
+            'hashed': self.hashed,
+        }
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        temp_path = self.path + '.tmp'
+        with io.open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(data, ensure_ascii=False))
+        os.rename(temp_path, self.path)
+
+    def store_tree(self, tree):
+        self.listings.update(
+            (path, entries) for path, entries in tree.items()
+            if path.startswith('/'))
+
+    def remote_hashes(self, root):
+        """
+        The cached hashes below ``root``, or None if they aren't all known.
+        """
+        if not any(within(root, hashed) for hashed in self.hashed):
+            return None
+        return dict(
+            (path, digest) for path, digest in self.hashes.items()
+            if within(path, root))
+
+    def store_hashes(self, root, hashes):
+        if not root.startswith('/'):
+            return
+        self.hashes.update(hashes)
+        self.hashed = [
+            hashed for hashed in self.hashed if not within(hashed, root)]
+        self.hashed.append(root)
+
+    def entry(self, path, isdir, size):
+        """
+        Add (or replace) an entry in its directory's listing, if that's
+        cached.
+        """
+        parent, name = posixpath.split(path)
+        entries = self.listings.get(parent)
+        if entries is None:
+            return
+        entries[:] = [entry for entry in entries if entry[0] != name]
+        entries.append([name, isdir, size, 0])
+
+    def hashing(self, path):
+        return any(within(path, hashed) for hashed in self.hashed)
+
+    def created(self, path):
+        """
+        Note a new (empty) directory.
+        """
+        if not path.startswith('/'):
+            return
+        self.parents(path)
+        self.entry(path, True, 0)
+        self.listings[path] = []
+        if self.hashing(path):
+            self.hashes[path] = None
+
+    def uploaded(self, path, local_path):
+        """
+        Note a file uploaded from ``local_path``.
+        """
+        if not path.startswith('/'):
+            return
+        self.parents(path)
+        self.entry(path, False, os.path.getsize(local_path))
+        if self.hashing(path):
+            self.hashes[path] = local_hash(local_path)
+
+    def parents(self, path):
+        """
+        Note the parent directory of a new path, if it's new too.
+        """
+        parent = posixpath.dirname(path)
+        grandparent = posixpath.dirname(parent)
+        entries = self.listings.get(grandparent)
+        if parent != grandparent and entries is not None and not any(
+                entry[0] == posixpath.basename(parent) for entry in entries):
+            self.created(parent)
+
+    def removed(self, path):
+        """
+        Note a file or directory (and everything below it) being removed.
+        """
+        for cached in (self.listings, self.hashes):
+            for key in [key for key in cached if within(key, path)]:
+                del cached[key]
+        parent, name = posixpath.split(path)
+        entries = self.listings.get(parent)
+        if entries:
+            entries[:] = [entry for entry in entries if entry[0] != name]
@@ -1,62 +1,632 @@
 from __future__ import unicode_literals
-import io
+import collections
 import json
+import struct
 import time
 
-import pyte
+RAW_BANNER = b'raw REPL; CTRL-B to exit\r\n'
+# Seen when the device (re)starts.
+BANNER = b'MicroPython v'
+SOFT_REBOOT = b'soft reboot'
+# Statements which the friendly REPL waits for more lines of.
+COMPOUND = (
+    'if ', 'for ', 'while ', 'with ', 'def ', 'class ', 'try:', '@')
+
+# Device side helper which calls a function, returning [result] or, if it
+# raised an exception, [None, error].
+TRY = '''\
+def _ut(f):
+    try:
+        return [f()]
+    except Exception as e:
+        return [None, '%s: %s' % (type(e).__name__, e)]
+'''
+
+
+class Timeout(ValueError):
+    """
+    Nothing arrived from the device in time.
+    """
+
+
+class ReadUntil(object):
+    """
+    The progress of reading a session's incoming data up to an ending,
+    shared by the blocking and asyncio readers (which each wait for data in
+    their own way).
+
+    Attributes:
+        deadline (float): when to give up waiting, pushed back whenever data
+            arrives
+    """
+
+    def __init__(self, comms, ending, timeout):
+        self.comms = comms
+        self.ending = ending
+        self.timeout = timeout
+        self.deadline = time.time() + timeout
+        # Where to search from (only new data is searched each time).
+        self.start = 0
+        # When the response started arriving, and how much has since.
+        self.started = None
+        self.size = 0
+
+    def take(self):
+        """
+        Remove and return the data up to and including the ending, or None
+        if it hasn't arrived yet.
+        """
+        buffer = self.comms.buffer
+        index = buffer.find(self.ending, self.start)
+        if index == -1:
+            self.start = max(0, len(buffer) - len(self.ending) + 1)
+            return None
+        if self.started is not None:
+            self.comms.stats.measure_throughput(
+                self.size, time.time() - self.started)
+        index += len(self.ending)
+        data = bytes(buffer[:index])
+        del buffer[:index]
+        return data
+
+    def received(self, size):
+        """
+        Note that ``size`` bytes just arrived.
+        """
+        if not size:
+            return
+        self.deadline = time.time() + self.timeout
+        if self.started is None:
+            self.started = time.time()
+        else:
+            self.size += size
+
+
+class LinkStats(object):
+    """
+    Running estimates of the link to the device, which size the timeouts of
+    reads that aren't given one.
+
+    Attributes:
+        baudrate (int): the port's configured baud rate (None if unknown)
+        latency (float): seconds from sending a statement to the first byte
+            of its response (None until measured)
+        throughput (float): bytes per second while a response is arriving
+            (None until measured)
+        received (int): bytes received in total
+        stalls (int): reads which timed out waiting for data
+    """
+    # Weight of each new measurement in the running estimates.
+    smoothing = 0.25
+    # Timeout used until there's anything to base one on.
+    default_timeout = 3
+    # Shortest timeout.
+    minimum_timeout = 1
+    # Shortest timeout for the output of a statement, allowing for code
+    # which takes a while to run.
+    code_timeout = 3
+    # Allowance for latency spikes.
+    latency_factor = 4
+    # Responses too short to measure throughput with.
+    minimum_sample = 64
+
+    def __init__(self, baudrate=None):
+        self.baudrate = baudrate
+        self.latency = None
+        self.throughput = None
+        self.received = 0
+        self.stalls = 0
+        self.sent_at = None
+
+    def average(self, estimate, sample):
+        if estimate is None:
+            return sample
+        return estimate + (sample - estimate) * self.smoothing
+
+    def sent(self):
+        """
+        Note that a statement was just sent, to measure the latency.
+        """
+        self.sent_at = time.time()
+
+    def receive(self, size):
+        self.received += size
+        if self.sent_at is not None:
+            self.latency = self.average(
+                self.latency, time.time() - self.sent_at)
+            self.sent_at = None
+
+    def measure_throughput(self, size, seconds):
+        if size >= self.minimum_sample and seconds > 0:
+            self.throughput = self.average(self.throughput, size / seconds)
+
+    @property
+    def rate(self):
+        """
+        Expected bytes per second, limited by the baud rate (with 10 bits
+        per byte on the wire).
+        """
+        rates = [self.throughput]
+        if self.baudrate:
+            rates.append(self.baudrate / 10.0)
+        rates = [rate for rate in rates if rate]
+        return min(rates) if rates else None
+
+    def timeout(self, expected=0, code=False):
+        """
+        Seconds to wait without receiving anything before giving up on a
+        response of about ``expected`` bytes (the output of running some
+        code, if ``code`` is set).
+        """
+        if self.latency is None:
+            timeout = self.default_timeout
+        else:
+            timeout = max(
+                self.code_timeout if code else self.minimum_timeout,
+                self.latency * self.latency_factor)
+        if expected and self.rate:
+            # Allow twice the transfer time for the device to produce it.
+            timeout += 2.0 * expected / self.rate
+        return timeout
 
 
 class Comms(object):
+    """
+    A session with the device's REPL.
+
+    A terminal's session (:attr:`uterm.terminal.Terminal.comms`) lives as long
+    as the terminal, so it remembers which modules have already been
+    imported on the device until it sees the device reset.
+
+    Reads which aren't given a timeout size one from :attr:`stats`. Timeouts
+    only end a read once nothing has arrived for that long, so a long
+    response which keeps arriving never times out.
+    """
+    # Longest line sent to the friendly REPL in one go, so the device's
+    # input buffer doesn't overflow (see pipeline's window_bytes).
+    line_bytes = 256
 
     def __init__(self, terminal, silent=False):
         self.terminal = terminal
         self.terminal.tx(b'\x03')
         self.imports = []
         self.silent = silent
+        # Incoming data which hasn't been consumed yet.
+        self.buffer = bytearray()
+        # The end of the data last watched, in case a banner is split.
+        self.tail = b''
+        self.raw = False
+        # Whether the firmware supports raw-paste mode (None until we've
+        # asked it).
+        self.raw_paste = None
+        # Version of the helper module installed on the device (None until
+        # we've asked it, see :mod:`uterm.agent`).
+        self.agent_version = None
+        # The device's metadata cache (None until looked up, False if the
+        # device has no unique id, see :mod:`uterm.cache`).
+        self.device_cache = None
+        # Whether the firmware's binascii has crc32 (None until we've
+        # asked it).
+        self.crc32 = None
+        baudrate = getattr(getattr(terminal, 'port', None), 'baudrate', None)
+        self.stats = LinkStats(
+            baudrate if isinstance(baudrate, int) else None)
+
+    def interrupt(self):
+        """
+        Stop any running program, waiting for the friendly REPL's prompt.
+        """
+        self.exit_raw()
+        self.terminal.tx(b'\x03')
+        del self.buffer[:]
+        try:
+            self.read_until(b'>>> ', timeout=0.5)
+        except ValueError:
+            pass
+
+    def watch(self, data):
+        """
+        Watch incoming data for the device resetting, forgetting what was
+        known about its state if it has.
+        """
+        data = self.tail + data
+        # Too short to hold a whole banner, so one can't be seen twice.
+        self.tail = data[-(len(BANNER) - 1):]
+        # Leaving the raw REPL shows the banner too, which isn't a reset.
+        if SOFT_REBOOT in data or (BANNER in data and not self.raw):
+            self.imports = []
 
     def import_module(self, name, silent=None):
         if name in self.imports:
             return
-        self.send('import %s' % name, silent=silent)
+        self.execute('import %s' % name, silent=silent)
+        self.imports.append(name)
+
+    def define(self, name, source, silent=None):
+        """
+        Define a helper on the device (remembered in the same way as
+        imports).
+        """
+        if name in self.imports:
+            return
+        self.execute(source, silent=silent)
         self.imports.append(name)
 
+    def execute(self, source, silent=None):
+        """
+        Run some (possibly multi-line) source in whichever REPL the device is
+        in, returning its output.
+
+        Raises:
+            ValueError: the source raised an exception in the raw REPL (the
+                friendly REPL just returns the traceback).
+        """
+        if self.raw:
+            output = self.raw_exec(source).decode('utf-8', 'replace')
+            return output.replace('\r\n', '\n').rstrip()
+        if '\n' in source.strip() or len(source) > self.line_bytes:
+            statement = 'exec(%r)' % source
+            if len(statement) > self.line_bytes:
+                # Too long for the device's input buffer, so build the source
+                # up over several lines.
+                self.send("_ut_s = ''", silent=silent)
+                for chunk in self.source_chunks(source, '_ut_s += '):
+                    self.send('_ut_s += %r' % chunk, silent=silent)
+                statement = 'exec(_ut_s); del _ut_s'
+            source = statement
+        return self.send(source, silent=silent)
+
+    def source_chunks(self, source, prefix):
+        """
+        Split source into pieces whose literals fit a line of
+        :attr:`line_bytes` after ``prefix``.
+        """
+        room = self.line_bytes - len(prefix)
+        start = 0
+        while start < len(source):
+            end = start + room
+            while True:
+                # Escaped characters take more room, so shrink by the excess.
+                excess = len('%r' % source[start:end]) - room
+                if excess <= 0:
+                    break
+                end -= excess
+            yield source[start:end]
+            start = end
+
     def json(self, command, silent=None):
         self.import_module('json', silent=silent)
-        output = ('print(json.dumps(%s))' % command.strip()).encode()
-        response = self.send(output, silent=silent)[len(output):]
+        output = 'print(json.dumps(%s))' % command.strip()
+        response = self.execute(output, silent=silent)
         try:
             return json.loads(response)
         except ValueError:
             pass
 
-    def send(self, text, silent=None):
+    def json_batch(self, expressions, silent=None):
+        """
+        Evaluate several expressions on the device in a single round trip.
+
+        Returns:
+            A list with the result of each expression, or a ``ValueError``
+            for any expression which raised an exception on the device.
+        """
+        if not expressions:
+            return []
+        self.define('_ut', TRY, silent=silent)
+        return self.batch_results(
+            (self.json(command, silent=silent)
+             for command in self.batch_commands(expressions)),
+            expressions)
+
+    def batch_results(self, batches, expressions):
+        """
+        Combine the results of each of a batch's commands, turning the
+        expressions which raised an exception into ``ValueError``.
+        """
+        results = []
+        for batch in batches:
+            if batch is None:
+                raise ValueError(
+                    'Could not evaluate {!r}'.format(expressions))
+            results.extend(batch)
+        return [
+            result[0] if len(result) == 1 else ValueError(result[1])
+            for result in results]
+
+    def batch_commands(self, expressions):
+        """
+        Group the expressions of a batch into as few commands as fit in
+        :attr:`line_bytes` (just the one in the raw REPL, which reads the
+        whole command before running it).
+        """
+        groups = [[]]
+        # Allow for the print(json.dumps(...)) around each command.
+        size = overhead = len('print(json.dumps([]))\r')
+        for expression in expressions:
+            expression = '_ut(lambda: %s)' % expression
+            size += len(expression) + 2
+            if groups[-1] and not self.raw and size > self.line_bytes:
+                groups.append([])
+                size = overhead + len(expression) + 2
+            groups[-1].append(expression)
+        return ['[%s]' % ', '.join(group) for group in groups]
+
+    def send(self, text, silent=None, expected=0):
+        """
+        Run a statement in the friendly REPL, returning its output (without
+        the echoed statement).
+
+        ``expected`` is the rough size of the output, to allow for slow
+        links.
+        """
         if hasattr(text, 'encode'):
             text = text.encode()
-        text += b'\r'
-        self.terminal.tx(text)
-        # Wait for ok
-        stream = pyte.ByteStream()
-        width = 1000
-        screen = pyte.Screen(width, 10)
-        stream.attach(screen)
-        incoming = io.BytesIO()
         if silent is None:
             silent = self.silent
-        timeout = time.time() + 3
+        self.terminal.tx(text + b'\r')
+        self.stats.sent()
+        timeout = self.stats.timeout(expected + len(text), code=True)
+        response = self.read_until(
+            b'>>> ', timeout=timeout, silent=silent)[:-4]
+        return self.strip_echo(text, response)
+
+    def stream(self, command, timeout=None):
+        """
+        Run a statement in the friendly REPL, yielding its output as it
+        arrives (as bytes, with newlines normalised to ``\\n``) until the
+        prompt returns.
+
+        Only the data not yet yielded is held, so output of any length can
+        be streamed. Waits as long as the statement runs unless
+        ``timeout`` is given, which ends it once nothing has arrived for
+        that long. Stopping early (closing the generator, or a
+        ``KeyboardInterrupt``) interrupts the statement with ctrl-c.
+
+        Multi-line and compound statements are run with ``exec``, so the
+        REPL doesn't wait for more lines.
+        """
+        if hasattr(command, 'decode'):
+            command = command.decode()
+        command = command.strip()
+        if '\n' in command or command.startswith(COMPOUND):
+            command = 'exec(%r)' % command
+        self.terminal.tx(command.encode() + b'\r')
+        self.stats.sent()
+        done = False
+        try:
+            # Skip the echoed statement.
+            self.read_until(b'\r\n')
+            # Held back in case it's the start of the prompt (or a \r\n).
+            keep = len(b'>>> ') - 1
+            deadline = timeout and time.time() + timeout
+            while True:
+                index = self.buffer.find(b'>>> ')
+                if index != -1:
+                    end = index
+                else:
+                    end = max(0, len(self.buffer) - keep)
+                    if end > 0 and self.buffer[end - 1:end] == b'\r':
+                        end -= 1
+                data = bytes(self.buffer[:end])
+                del self.buffer[:end]
+                if data:
+                    yield data.replace(b'\r\n', b'\n')
+                if index != -1:
+                    del self.buffer[:4]
+                    done = True
+                    return
+                if deadline:
+                    self.wait(deadline)
+                else:
+                    self.terminal.wait(1)
+                if self.fill() and timeout:
+                    deadline = time.time() + timeout
+        finally:
+            if not done:
+                self.interrupt()
+
+    def pipeline(self, statements, window=4, window_bytes=256,
+                 raise_errors=True):
+        """
+        Send statements to the friendly REPL, keeping up to ``window`` of
+        them (and at most ``window_bytes``, so the device's input buffer
+        doesn't overflow) in flight rather than waiting for each prompt.
+
+        Statements can't be ones which need more input (a compound statement
+        needs its explicit trailing ``\\r``). Output is always silent.
+
+        Yields:
+            Tuple (bytes, str): each statement and its output, in order.
+
+        Raises:
+            ValueError: a statement raised an exception (if
+                ``raise_errors``), or the device stopped responding.
+        """
+        lines = (
+            (text.encode() if hasattr(text, 'encode') else text) + b'\r'
+            for text in statements)
+        pending = collections.deque()
+        in_flight = 0
+        line = next(lines, None)
+        while pending or line is not None:
+            # Only send more once enough prompts have come back.
+            while line is not None and len(pending) < window:
+                if pending and in_flight + len(line) > window_bytes:
+                    break
+                self.terminal.tx(line)
+                self.stats.sent()
+                pending.append(line)
+                in_flight += len(line)
+                line = next(lines, None)
+            sent = pending.popleft()
+            in_flight -= len(sent)
+            sent = sent[:-1]
+            output = self.read_response(sent)
+            if raise_errors and 'Traceback (most recent call last)' in output:
+                raise ValueError('{!r} failed:\n{}'.format(sent, output))
+            yield sent, output
+
+    def read_response(self, statement):
+        """
+        Read the output of a statement sent to the friendly REPL, up to the
+        next prompt.
+        """
+        while True:
+            response = self.read_until(
+                b'>>> ', timeout=self.stats.timeout(code=True))[:-4]
+            # Skip stray prompts (such as the one from a ctrl-c).
+            if response.strip():
+                break
+        return self.strip_echo(statement, response)
+
+    def strip_echo(self, statement, response):
+        """
+        Return the output from a friendly REPL response, skipping the echo
+        (one line for each line of the statement).
+        """
+        lines = response.split(b'\r\n')[statement.count(b'\r') + 1:]
+        return b'\n'.join(lines).decode('utf-8', 'replace').rstrip()
+
+    def fill(self, silent=True):
+        """
+        Move any waiting incoming data into the buffer.
+        """
+        data = self.terminal.rx(silent=silent)
+        if data:
+            self.buffer += data
+            self.stats.receive(len(data))
+        return data
+
+    def wait(self, deadline):
+        """
+        Block until there is incoming data.
+
+        Raises:
+            Timeout: nothing arrived before the deadline.
+        """
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            self.stats.stalls += 1
+            raise Timeout('Timeout')
+        self.terminal.wait(remaining)
+
+    def read(self, size, timeout=None):
+        """
+        Read exactly ``size`` bytes from the device, waiting up to
+        ``timeout`` seconds for each part of it.
+        """
+        if timeout is None:
+            timeout = self.stats.timeout(size)
+        deadline = time.time() + timeout
+        while len(self.buffer) < size:
+            self.wait(deadline)
+            if self.fill():
+                deadline = time.time() + timeout
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def read_until(self, ending, timeout=None, silent=True):
+        """
+        Read from the device up to and including ``ending``, waiting up to
+        ``timeout`` seconds for each part of it.
+        """
+        if timeout is None:
+            timeout = self.stats.timeout()
+        until = ReadUntil(self, ending, timeout)
         while True:
-            if time.time() > timeout:
-                raise ValueError('Timeout')
-            data = self.terminal.rx(silent=silent)
-            if not data:
-                continue
-            stream.feed(data)
-            incoming.write(data)
-            incoming.seek(-4, io.SEEK_END)
-            if incoming.read() == b'>>> ':
-                output = io.StringIO()
-                for line in screen.display:
-                    line = line.strip()
-                    output.write(line)
-                    if len(line) < width:
-                        output.write(u'\n')
-                return output.getvalue().rstrip()[:-3]
+            data = until.take()
+            if data is not None:
+                return data
+            self.wait(until.deadline)
+            until.received(len(self.fill(silent) or b''))
+
+    def enter_raw(self):
+        """
+        Switch the device to the raw REPL.
+        """
+        del self.buffer[:]
+        self.terminal.write(b'\r\x03\x01')
+        self.read_until(RAW_BANNER)
+        self.raw = True
+
+    def exit_raw(self):
+        """
+        Return the device to the friendly REPL (if it's in the raw REPL).
+        """
+        if not self.raw:
+            return
+        self.terminal.write(b'\x02')
+        self.read_until(b'>>> ')
+        del self.buffer[:]
+        self.raw = False
+
+    def raw_exec(self, source, timeout=None):
+        """
+        Execute some source while in the raw REPL, returning its output.
+
+        Uses raw-paste mode (with the device's flow control window) when the
+        firmware supports it, otherwise plain raw REPL. ``timeout`` is how
+        long the command may run without output (sized from the link
+        statistics by default).
+
+        Raises:
+            ValueError: the device raised an exception or didn't respond.
+        """
+        if hasattr(source, 'encode'):
+            source = source.encode()
+        self.read_until(b'>')
+        if self.raw_paste is not False:
+            self.terminal.write(b'\x05A\x01')
+            response = self.read(2)
+            if response == b'R\x01':
+                self.raw_paste = True
+                self._raw_paste_write(source)
+                return self._raw_follow(timeout)
+            if response != b'R\x00':
+                # Firmware without raw-paste mode just redisplays the raw
+                # REPL banner (the first two bytes of which were just read).
+                self.read_until(RAW_BANNER[2:] + b'>')
+            self.raw_paste = False
+        for i in range(0, len(source), 256):
+            self.terminal.write(source[i:i + 256])
+            time.sleep(0.01)
+        self.terminal.write(b'\x04')
+        if self.read(2) != b'OK':
+            raise ValueError('Could not execute command')
+        return self._raw_follow(timeout)
+
+    def _raw_paste_write(self, source):
+        window = struct.unpack('<H', self.read(2))[0]
+        remaining = window
+        sent = 0
+        while sent < len(source):
+            self.fill()
+            while remaining == 0 or self.buffer:
+                data = self.read(1)
+                if data == b'\x01':
+                    # Device has room for another window of data.
+                    remaining += window
+                elif data == b'\x04':
+                    # Device ended the paste early (e.g. a syntax error).
+                    self.terminal.write(b'\x04')
+                    return
+                else:
+                    raise ValueError(
+                        'Unexpected data during raw paste: %r' % data)
+            chunk = source[sent:sent + remaining]
+            self.terminal.write(chunk)
+            remaining -= len(chunk)
+            sent += len(chunk)
+        self.terminal.write(b'\x04')
+        self.read_until(b'\x04')
+
+    def _raw_follow(self, timeout):
+        if timeout is None:
+            timeout = self.stats.timeout(code=True)
+        output = self.read_until(b'\x04', timeout=timeout)[:-1]
+        error = self.read_until(b'\x04', timeout=timeout)[:-1]
+        if error:
+            raise ValueError(error.decode('utf-8', 'replace'))
+        return output
@@ -19,16 +19,24 @@ Otherwise, the following commands are valid:
     ls [<path>]  List files
     cd <path>    Change directory
     pwd          Show the current working directory
+    sync <dir>   Upload changed files from a local directory
+    bench <file> Compare upload strategies using a local file
+    agent        Install the device side helper module
+    link         Measure and show statistics of the link to the device
 
 For command help, run:
     uterm <command> --help
 """
-import json
+from __future__ import print_function
+import base64
+import codecs
 import sys
 
 import serial
 import uterm
 from docopt import docopt
+from uterm import actions, agent, bench
+from uterm.sync import Sync
 from uterm.terminal import Terminal
 
 
@@ -42,12 +50,19 @@ def run_uterm(terminal):
 
 
 def _exec(terminal, command):
-    terminal.send_command(command)
-    while True:
-        data = terminal.rx(silent=True, readline=True)
-        if not data or data == '>>> ':
-            break
-        sys.stdout.write(data)
+    comms = terminal.comms
+    comms.interrupt()
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    for data in comms.stream(command):
+        stdout.write(data)
+        stdout.flush()
+
+
+def _session(terminal):
+    comms = terminal.comms
+    comms.interrupt()
+    comms.import_module('os')
+    return comms
 
 
 def uterm_ls(terminal, args):
@@ -57,12 +72,17 @@ def uterm_ls(terminal, args):
     usage: uterm ls [<path>]
     """
     path = args['<path>'] or ''
-    terminal.send_command(
-        'import json;import os;d=os.listdir({!r});'
-        'd.sort(key=lambda p: (os.stat(p)[0] != 0o040000, p));'
-        'print(json.dumps(d))'.format(path))
-    data = terminal.rx(silent=True, readline=True)
-    for path in json.loads(data):
+    comms = _session(terminal)
+    if agent.installed(comms):
+        entries = comms.json('{}.ls({!r})'.format(agent.NAME, path))
+        listing = [
+            name for isdir, name in sorted(
+                (not entry[1], entry[0]) for entry in entries)]
+    else:
+        listing = comms.json(
+            'sorted(os.listdir({!r}), '
+            'key=lambda p: (os.stat(p)[0] != 0o040000, p))'.format(path))
+    for path in listing:
         print(path)
 
 
@@ -72,7 +92,7 @@ def uterm_pwd(terminal, args):
 
     usage: uterm pwd
     """
-    _exec(terminal, 'import os;print(os.getcwd())')
+    print(_session(terminal).json('os.getcwd()'))
 
 
 def uterm_cd(terminal, args):
@@ -81,7 +101,9 @@ def uterm_cd(terminal, args):
 
     usage: uterm cd <path>
     """
-    _exec(terminal, 'import os;os.chdir({!r})'.format(args['<path>']))
+    output = _session(terminal).send('os.chdir({!r})'.format(args['<path>']))
+    if output:
+        print(output)
 
 
 def uterm_get(terminal, args):
@@ -90,6 +112,22 @@ def uterm_get(terminal, args):
 
     usage: uterm get [--] <file>
     """
+    comms = _session(terminal)
+    if agent.installed(comms):
+        # Read in ranges, so large files don't need to fit in device memory.
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        offset = 0
+        while True:
+            data = comms.json('{}.read({!r}, {}, 512)'.format(
+                agent.NAME, args['<file>'], offset))
+            if data is None:
+                exit('Could not read {}'.format(args['<file>']))
+            data = base64.b64decode(data)
+            offset += len(data)
+            sys.stdout.write(decoder.decode(data, final=not data))
+            if not data:
+                break
+        return
     command = (
         'with open("{}") as f:\n'
         '  print(f.read())').format(args['<file>'])
@@ -105,11 +143,86 @@ def uterm_exec(terminal, args):
     _exec(terminal, args['<command>'])
 
 
+def uterm_sync(terminal, args):
+    """
+    Upload the files in a local directory which differ from those on the
+    device.
+
+    usage: uterm sync [--prune] [--compress] <local_dir> [<remote_dir>]
+
+    Options:
+        --prune     Remove remote files which don't exist locally
+        --compress  Compress uploads (if the device can decompress them)
+    """
+    sync = Sync(
+        args['<local_dir>'], args['<remote_dir>'] or '',
+        prune=args['--prune'], compress=args['--compress'],
+        update_func=lambda path: print(path))
+    sync(terminal)
+    for path in sync.removed:
+        print('Removed {}'.format(path))
+    print('{} uploaded, {} unchanged, {} removed'.format(
+        len(sync.uploaded), len(sync.unchanged), len(sync.removed)))
+
+
+def uterm_bench(terminal, args):
+    """
+    Compare the wall time of plain and compressed uploads of a local file.
+    The file is uploaded to the device's working directory.
+
+    usage: uterm bench [--repeat=<n>] <file>
+
+    Options:
+        --repeat=<n>  Number of uploads per strategy [default: 3]
+    """
+    results = bench.upload(
+        terminal, args['<file>'], repeat=int(args['--repeat']))
+    plain = results[0][1]
+    for name, seconds, overhead in results:
+        print('{:<12}{:>8.2f}s {:>6.2f}x wire overhead {:>6.2f}x speed'.format(
+            name, seconds, overhead or 0, plain / seconds))
+
+
+def uterm_agent(terminal, args):
+    """
+    Install (or update) the device side helper module, which saves sending
+    the source of common operations to the device.
+
+    usage: uterm agent
+    """
+    actions.install_agent(terminal)
+    print('Installed {} version {}'.format(agent.PATH, agent.VERSION))
+
+
+def uterm_link(terminal, args):
+    """
+    Measure the link to the device with some round trips, then show its
+    statistics.
+
+    usage: uterm link [--count=<n>]
+
+    Options:
+        --count=<n>  Number of round trips [default: 10]
+    """
+    comms = _session(terminal)
+    for i in range(int(args['--count'])):
+        # Long enough to measure the throughput.
+        comms.json('"x" * 256', silent=True)
+    stats = comms.stats
+    print('baud rate:  {}'.format(stats.baudrate or 'unknown'))
+    print('latency:    {:.1f}ms'.format((stats.latency or 0) * 1000))
+    print('throughput: {:.0f} B/s'.format(stats.throughput or 0))
+    print('timeout:    {:.2f}s'.format(stats.timeout()))
+    print('received:   {} bytes, {} stalls'.format(
+        stats.received, stats.stalls))
+
+
 def main():
     args = docopt(__doc__, version=uterm.__version__, options_first=True)
     port = serial.Serial(args['--port'], int(args['--baudrate']))
     log = open(args['--log'], 'wb') if args['--log'] else None
     terminal = Terminal(port, log=log)
+    terminal.start_reader()
 
     try:
         command = args['<command>']
@@ -123,6 +236,7 @@ def main():
         else:
             run_uterm(terminal)
     finally:
+        terminal.stop_reader()
         if log:
             log.close()
 
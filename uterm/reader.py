@@ -0,0 +1,162 @@
+"""
+Draining the serial port on a background thread, so incoming data isn't lost
+while the terminal is busy (such as repainting under heavy output).
+"""
+from __future__ import unicode_literals
+import os
+import threading
+
+
+class RingBuffer(object):
+    """
+    A bounded first in, first out byte buffer, backed by a preallocated
+    bytearray.
+
+    Attributes:
+        dropped (int): bytes discarded (oldest first) to make room
+    """
+
+    def __init__(self, size):
+        self.data = bytearray(size)
+        self.size = size
+        self.start = 0
+        self.length = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def free(self):
+        return self.size - self.length
+
+    def write(self, data):
+        """
+        Add data, dropping the oldest data if there isn't room.
+        """
+        if len(data) > self.size:
+            self.dropped += len(data) - self.size
+            data = data[-self.size:]
+        overflow = len(data) - self.free
+        if overflow > 0:
+            self.dropped += overflow
+            self.start = (self.start + overflow) % self.size
+            self.length -= overflow
+        end = (self.start + self.length) % self.size
+        first = min(len(data), self.size - end)
+        self.data[end:end + first] = data[:first]
+        self.data[:len(data) - first] = data[first:]
+        self.length += len(data)
+
+    def read(self, size=None):
+        """
+        Remove and return up to ``size`` bytes (everything by default).
+        """
+        if size is None or size > self.length:
+            size = self.length
+        first = min(size, self.size - self.start)
+        data = bytes(self.data[self.start:self.start + first]) + bytes(
+            self.data[:size - first])
+        self.start = (self.start + size) % self.size
+        self.length -= size
+        return data
+
+
+class Reader(object):
+    """
+    Read a port on a background thread into a :class:`RingBuffer`.
+
+    :meth:`fileno` is readable whenever data is buffered (a self-pipe), so
+    callers can still block on it with ``select``.
+
+    When the buffer is full, the thread waits up to ``backpressure_timeout``
+    seconds for it to be read before dropping the oldest data.
+
+    Attributes:
+        backpressured (int): reads which had to wait for room
+        dropped (int): bytes dropped because the buffer stayed full
+    """
+    backpressure_timeout = 0.1
+    # Seconds each port read blocks for, so the thread notices a stop.
+    read_timeout = 0.05
+
+    def __init__(self, port, size=1 << 16):
+        self.port = port
+        self.buffer = RingBuffer(size)
+        self.condition = threading.Condition()
+        self.backpressured = 0
+        self.error = None
+        self.pipe_read, self.pipe_write = os.pipe()
+        self.signalled = False
+        self.running = False
+        self.thread = None
+
+    @property
+    def dropped(self):
+        return self.buffer.dropped
+
+    def fileno(self):
+        return self.pipe_read
+
+    def start(self):
+        self.port.timeout = self.read_timeout
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        os.close(self.pipe_read)
+        os.close(self.pipe_write)
+
+    def run(self):
+        while self.running:
+            try:
+                data = self.port.read(max(1, self.port.inWaiting()))
+            except Exception as e:
+                # Passed on to the reading thread.
+                with self.condition:
+                    self.error = e
+                    self.signal()
+                return
+            if data:
+                self.store(data)
+
+    def store(self, data):
+        with self.condition:
+            if len(data) > self.buffer.free:
+                self.backpressured += 1
+                self.condition.wait(self.backpressure_timeout)
+            self.buffer.write(data)
+            self.signal()
+
+    def signal(self):
+        if not self.signalled:
+            os.write(self.pipe_write, b'.')
+            self.signalled = True
+
+    def in_waiting(self):
+        return len(self.buffer)
+
+    def read(self):
+        """
+        Return all buffered data.
+
+        Raises:
+            The exception which stopped the thread (such as the port being
+            disconnected), once the data before it has been read.
+        """
+        with self.condition:
+            data = self.buffer.read()
+            # Stay readable until the error has been raised.
+            if self.signalled and not self.error:
+                os.read(self.pipe_read, 1)
+                self.signalled = False
+            self.condition.notify()
+            if not data and self.error:
+                raise self.error
+        return data
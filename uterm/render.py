@@ -0,0 +1,129 @@
+"""
+Painting a pyte screen to a curses window.
+"""
+from __future__ import unicode_literals
+import sys
+
+import curses
+
+# pyte colour names to curses colour numbers.
+COLORS = {
+    'black': curses.COLOR_BLACK,
+    'red': curses.COLOR_RED,
+    'green': curses.COLOR_GREEN,
+    'brown': curses.COLOR_YELLOW,
+    'yellow': curses.COLOR_YELLOW,
+    'blue': curses.COLOR_BLUE,
+    'magenta': curses.COLOR_MAGENTA,
+    'cyan': curses.COLOR_CYAN,
+    'white': curses.COLOR_WHITE,
+}
+
+ATTRIBUTES = (
+    ('bold', curses.A_BOLD),
+    ('underscore', curses.A_UNDERLINE),
+    ('reverse', curses.A_REVERSE),
+    ('blink', curses.A_BLINK),
+    ('italics', getattr(curses, 'A_ITALIC', 0)),
+)
+
+
+class Renderer(object):
+    """
+    Paint the dirty lines of a pyte screen to a curses window, only sending
+    curses the runs of cells which changed since they were last painted.
+
+    Colours are mapped to curses colour pairs, allocated as each combination
+    is first seen (when the terminal supports colour).
+
+    Attributes:
+        calls (int): curses calls made painting
+    """
+
+    def __init__(self, window, colors=None):
+        self.window = window
+        if colors is None:
+            try:
+                colors = curses.has_colors()
+            except curses.error:
+                colors = False
+        self.colors = colors
+        # The (text, attribute) of each cell last painted, by line.
+        self.painted = {}
+        self.pairs = {}
+        self.calls = 0
+
+    def color(self, name, default):
+        """
+        The curses colour number for a pyte colour name.
+        """
+        bright = name.startswith('bright')
+        if bright:
+            name = name[6:]
+        color = COLORS.get(name, default)
+        if bright and color != default and curses.COLORS >= 16:
+            color += 8
+        return color
+
+    def pair(self, fg, bg):
+        key = (fg, bg)
+        if key not in self.pairs:
+            number = len(self.pairs) + 1
+            if number >= curses.COLOR_PAIRS:
+                # Out of pairs, so use the default colours.
+                return 0
+            curses.init_pair(number, fg, bg)
+            self.pairs[key] = number
+        return curses.color_pair(self.pairs[key])
+
+    def attribute(self, char):
+        """
+        The curses attribute for a pyte character.
+        """
+        attr = 0
+        for name, value in ATTRIBUTES:
+            if getattr(char, name, False):
+                attr |= value
+        if self.colors and (char.fg != 'default' or char.bg != 'default'):
+            attr |= self.pair(self.color(char.fg, -1), self.color(char.bg, -1))
+            if char.fg.startswith('bright') and curses.COLORS < 16:
+                attr |= curses.A_BOLD
+        return attr
+
+    def cells(self, screen, y):
+        line = screen.buffer[y]
+        return [
+            (char.data, self.attribute(char))
+            for char in (line[x] for x in range(screen.columns))]
+
+    def paint(self, screen):
+        """
+        Paint the screen's dirty lines, then clear them.
+        """
+        for y in sorted(screen.dirty):
+            cells = self.cells(screen, y)
+            self.paint_line(y, cells, self.painted.get(y))
+            self.painted[y] = cells
+        screen.dirty.clear()
+        self.window.move(screen.cursor.y, screen.cursor.x)
+        self.calls += 1
+
+    def paint_line(self, y, cells, old):
+        x = 0
+        while x < len(cells):
+            if old and old[x] == cells[x]:
+                x += 1
+                continue
+            start, attr = x, cells[x][1]
+            while x < len(cells) and cells[x][1] == attr and not (
+                    old and old[x] == cells[x]):
+                x += 1
+            text = ''.join(data for data, _ in cells[start:x])
+            if sys.version_info[0] < 3:
+                text = text.encode('utf-8')
+            try:
+                self.window.addstr(y, start, text, attr)
+            except curses.error:
+                # Writing the bottom right cell moves the cursor off screen.
+                pass
+            self.calls += 1
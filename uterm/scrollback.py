@@ -0,0 +1,269 @@
+"""
+Output which has scrolled off the terminal's screen.
+"""
+from __future__ import unicode_literals
+import curses
+
+import pyte
+
+ESC = 27
+
+
+def trigrams(text):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class Scrollback(object):
+    """
+    Lines which scrolled off the terminal screen, kept within a memory
+    budget (evicting the oldest lines first).
+
+    Each line is stored as utf-8 bytes plus a tuple of run-length
+    ``(characters, curses attribute)`` spans, and indexed by lowercased
+    trigram so searches only check lines which could match.
+
+    Line numbers are absolute: a line keeps its number as older lines are
+    evicted, so valid numbers run from :attr:`first` to :attr:`end`.
+    """
+    # Rough bytes of overhead per line and per index entry.
+    line_overhead = 64
+    index_overhead = 8
+
+    def __init__(self, budget=4 << 20):
+        self.budget = budget
+        self.size = 0
+        self.first = 0
+        self.lines = []
+        # Evicted lines at the start of self.lines, removed in batches.
+        self.start = 0
+        self.index = {}
+
+    def __len__(self):
+        return len(self.lines) - self.start
+
+    @property
+    def end(self):
+        return self.first + len(self)
+
+    def line_size(self, text, spans, grams):
+        return (
+            len(text) + self.line_overhead + len(spans) * 16 +
+            len(grams) * self.index_overhead)
+
+    def append(self, text, spans=()):
+        text = text.encode('utf-8')
+        spans = tuple(spans)
+        grams = trigrams(text.lower())
+        number = self.end
+        self.lines.append((text, spans))
+        for gram in grams:
+            self.index.setdefault(gram, []).append(number)
+        self.size += self.line_size(text, spans, grams)
+        while self.size > self.budget and len(self) > 1:
+            self.evict()
+
+    def evict(self):
+        text, spans = self.lines[self.start]
+        self.lines[self.start] = None
+        self.start += 1
+        grams = trigrams(text.lower())
+        for gram in grams:
+            postings = self.index[gram]
+            # Postings are in line order, so the evicted line is first.
+            del postings[0]
+            if not postings:
+                del self.index[gram]
+        self.size -= self.line_size(text, spans, grams)
+        self.first += 1
+        if self.start > len(self.lines) // 2:
+            del self.lines[:self.start]
+            self.start = 0
+
+    def get(self, number):
+        """
+        Return the (text, spans) of a line.
+        """
+        text, spans = self.lines[self.start + number - self.first]
+        return text.decode('utf-8'), spans
+
+    def search(self, query, before=None):
+        """
+        Find the latest line before line number ``before`` (by default, the
+        end) which contains ``query`` (ignoring case).
+
+        Returns:
+            The line number, or None if there's no match.
+        """
+        if before is None or before > self.end:
+            before = self.end
+        query = query.lower().encode('utf-8')
+        if len(query) < 3:
+            candidates = range(before - 1, self.first - 1, -1)
+        else:
+            postings = [self.index.get(gram) for gram in trigrams(query)]
+            if not all(postings):
+                return None
+            candidates = (
+                number for number in reversed(min(postings, key=len))
+                if number < before)
+        for number in candidates:
+            text, _ = self.lines[self.start + number - self.first]
+            if query in text.lower():
+                return number
+        return None
+
+
+class HistoryScreen(pyte.DiffScreen):
+    """
+    A pyte screen which saves lines scrolling off its top to a
+    :class:`Scrollback`.
+
+    ``attribute`` maps a pyte character to the curses attribute stored with
+    it.
+    """
+
+    def __init__(self, columns, lines, scrollback, attribute=None):
+        self.scrollback = scrollback
+        self.attribute = attribute or (lambda char: 0)
+        super(HistoryScreen, self).__init__(columns, lines)
+
+    def index(self):
+        top, bottom = self.margins or (0, self.lines - 1)
+        if top == 0 and self.cursor.y == bottom:
+            self.scrollback.append(*self.compact(self.buffer[top]))
+        super(HistoryScreen, self).index()
+
+    def compact(self, line):
+        """
+        Convert a line of pyte characters to text and run-length attribute
+        spans, dropping trailing blanks.
+        """
+        chars = [line[x] for x in range(self.columns)]
+        while chars and chars[-1].data in ('', ' ') and not (
+                self.attribute(chars[-1])):
+            chars.pop()
+        text, spans = [], []
+        for char in chars:
+            if not char.data:
+                # The second cell of a wide character.
+                continue
+            text.append(char.data)
+            attr = self.attribute(char)
+            if spans and spans[-1][1] == attr:
+                spans[-1][0] += 1
+            else:
+                spans.append([1, attr])
+        return ''.join(text), [tuple(span) for span in spans]
+
+
+class Viewer(object):
+    """
+    Page through the scrollback (followed by the current screen), with
+    incremental search.
+
+    Keys: arrows and page up / down scroll, ``/`` starts a search (matches
+    are found as you type, enter keeps the result), ``n`` finds the next
+    older match and escape or ``q`` exits.
+    """
+
+    def __init__(self, scrollback, screen_lines=()):
+        self.scrollback = scrollback
+        self.screen_lines = list(screen_lines)
+        self.query = ''
+        self.match = None
+
+    @property
+    def end(self):
+        return self.scrollback.end + len(self.screen_lines)
+
+    def line(self, number):
+        if number >= self.scrollback.end:
+            return self.screen_lines[number - self.scrollback.end], ()
+        return self.scrollback.get(number)
+
+    def search(self, before=None):
+        if before is None:
+            before = self.end
+        for number in range(
+                min(before, self.end) - 1, self.scrollback.end - 1, -1):
+            if self.query.lower() in self.screen_lines[
+                    number - self.scrollback.end].lower():
+                return number
+        return self.scrollback.search(self.query, before)
+
+    def draw(self, window, top, height, width):
+        for y in range(height):
+            window.move(y, 0)
+            window.clrtoeol()
+            number = top + y
+            if number >= self.end:
+                continue
+            text, spans = self.line(number)
+            x = 0
+            for count, attr in spans or [(len(text), 0)]:
+                if x >= width - 1:
+                    break
+                if number == self.match:
+                    attr |= curses.A_REVERSE
+                window.addstr(y, x, text[x:x + count][:width - 1 - x], attr)
+                x += count
+        if self.query:
+            status = 'search: ' + self.query
+        else:
+            status = 'line {} of {}'.format(top + height, self.end)
+        window.move(height, 0)
+        window.clrtoeol()
+        window.addstr(height, 0, status[:width - 1], curses.A_BOLD)
+        window.refresh()
+
+    def run(self, window):
+        height, width = window.getmaxyx()
+        # Leave a line for the status.
+        height -= 1
+        bottom = self.end
+        searching = False
+        while True:
+            top = max(self.scrollback.first, bottom - height)
+            self.draw(window, top, height, width)
+            ch = window.getch()
+            found = False
+            if searching:
+                if ch in (ESC, ord('\n')):
+                    searching = False
+                    continue
+                if ch in (curses.KEY_BACKSPACE, 127, 8):
+                    self.query = self.query[:-1]
+                elif 32 <= ch < 127:
+                    self.query += chr(ch)
+                else:
+                    continue
+                self.match = self.search() if self.query else None
+                found = True
+            elif ch in (ESC, ord('q')):
+                return
+            elif ch == ord('/'):
+                searching = True
+                self.query = ''
+                self.match = None
+            elif ch == ord('n') and self.query:
+                before = self.match if self.match is not None else bottom
+                self.match = self.search(before)
+                found = True
+            elif ch == curses.KEY_UP:
+                bottom -= 1
+            elif ch == curses.KEY_DOWN:
+                bottom += 1
+            elif ch == curses.KEY_PPAGE:
+                bottom -= height
+            elif ch == curses.KEY_NPAGE:
+                bottom += height
+            elif ch == curses.KEY_HOME:
+                bottom = self.scrollback.first + height
+            elif ch == curses.KEY_END:
+                bottom = self.end
+            if found and self.match is not None and not (
+                    bottom - height <= self.match < bottom):
+                # Scroll to show the match.
+                bottom = self.match + height // 2
+            bottom = max(
+                min(bottom, self.end), self.scrollback.first + height)
@@ -0,0 +1,160 @@
+from __future__ import unicode_literals
+import json
+import os
+import posixpath
+
+from . import agent
+from .actions import BatchUploader
+from .cache import DeviceCache, local_hash
+
+# Device side source which prints the sha256 of every file (and None for
+# every directory) below a remote directory as a JSON object.
+REMOTE_HASHES = '''\
+import os, json, hashlib, binascii
+def _h(p):
+    h = hashlib.sha256()
+    with open(p, 'rb') as f:
+        while True:
+            b = f.read(512)
+            if not b:
+                break
+            h.update(b)
+    return binascii.hexlify(h.digest()).decode()
+def _w(d, r):
+    for n in os.listdir(d or '.'):
+        p = (d + '/' if d and d[-1] != '/' else d) + n
+        if os.stat(p)[0] & 0x4000:
+            r[p] = None
+            _w(p, r)
+        else:
+            r[p] = _h(p)
+    return r
+try:
+    _r = _w(%r, {%r: None})
+except OSError:
+    _r = {}
+print(json.dumps(_r))
+del _h, _w, _r
+'''
+
+
+class Sync(object):
+    """
+    Upload the files of a local directory which differ from the device's
+    copies.
+
+    Remote hashes are gathered in a single round trip (or taken from the
+    device's :class:`~uterm.cache.DeviceCache`), missing directories are
+    created and (if ``prune`` is set) remote files which no longer exist
+    locally are removed.
+
+    Attributes:
+        uploaded (list): remote paths uploaded by the last call
+        unchanged (list): remote paths skipped by the last call
+        removed (list): remote paths pruned by the last call
+    """
+
+    def __init__(self, local_dir, remote_dir='', prune=False,
+                 compress=False, update_func=None):
+        self.local_dir = os.path.normpath(local_dir)
+        self.remote_dir = remote_dir.rstrip('/') or remote_dir[:1]
+        self.prune = prune
+        self.compress = compress
+        self.update_func = update_func
+
+    def update(self, path):
+        if self.update_func:
+            self.update_func(path)
+
+    def remote_path(self, relative):
+        if not self.remote_dir:
+            return relative
+        return posixpath.join(self.remote_dir, relative)
+
+    def local_files(self):
+        """
+        Return a dict of remote paths to local paths, plus a list of the
+        remote directories that are needed.
+        """
+        files, dirs = {}, []
+        for root, dirnames, filenames in os.walk(self.local_dir):
+            dirnames[:] = sorted(
+                name for name in dirnames
+                if not name.startswith('.') and name != '__pycache__')
+            relative = os.path.relpath(root, self.local_dir)
+            relative = '' if relative == '.' else relative.replace(os.sep, '/')
+            if relative:
+                dirs.append(self.remote_path(relative))
+            for name in filenames:
+                if name.startswith('.') or name.endswith('.pyc'):
+                    continue
+                files[self.remote_path(posixpath.join(relative, name))] = (
+                    os.path.join(root, name))
+        return files, dirs
+
+    def remote_hashes(self, comms):
+        if agent.installed(comms):
+            source = agent.call('hashes', self.remote_dir)
+        else:
+            source = REMOTE_HASHES % (self.remote_dir, self.remote_dir)
+        return json.loads(comms.raw_exec(source, timeout=30).decode())
+
+    def __call__(self, terminal):
+        comms = terminal.comms
+        try:
+            return self.sync(terminal, comms)
+        finally:
+            # Don't leave the terminal's session in the raw REPL, even if
+            # the sync failed.
+            comms.exit_raw()
+
+    def sync(self, terminal, comms):
+        self.uploaded, self.unchanged, self.removed = [], [], []
+        files, dirs = self.local_files()
+        comms.enter_raw()
+        cache = DeviceCache.open(comms)
+        remote = cache and cache.remote_hashes(self.remote_dir)
+        if remote is None:
+            remote = self.remote_hashes(comms)
+            if cache:
+                cache.store_hashes(self.remote_dir, remote)
+        dirs.insert(0, self.remote_dir)
+        missing = [path for path in dirs if path not in remote]
+        if self.prune:
+            self.removed = sorted(
+                (path for path in remote if path not in files and
+                 path not in dirs), reverse=True)
+            if self.removed and agent.installed(comms):
+                comms.raw_exec('\n'.join(
+                    '%s.rmtree(%r)' % (agent.NAME, path)
+                    for path in self.removed
+                    if posixpath.dirname(path) not in self.removed),
+                    timeout=30)
+            elif self.removed:
+                # Reverse sorted so directories are emptied before removal.
+                comms.raw_exec(
+                    'import os\n'
+                    'for p in %r:\n  os.remove(p)\n'
+                    'for p in %r:\n  os.rmdir(p)' % (
+                        [path for path in self.removed if remote[path]],
+                        [path for path in self.removed if not remote[path]]),
+                    timeout=30)
+        for path in sorted(files):
+            if remote.get(path) == local_hash(files[path]):
+                self.unchanged.append(path)
+            else:
+                self.update(path)
+                self.uploaded.append(path)
+        uploader = BatchUploader(
+            [(files[path], path) for path in self.uploaded], dirs=missing,
+            compress=self.compress)
+        uploader(terminal, comms)
+        if cache:
+            for path in self.removed:
+                cache.removed(path)
+            for path in missing:
+                cache.created(path)
+            for path in self.uploaded:
+                cache.uploaded(path, files[path])
+            cache.save()
+        return True
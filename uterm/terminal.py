@@ -1,6 +1,8 @@
 from __future__ import unicode_literals
 import argparse
+import locale
 import os
+import select
 import time
 
 import serial
@@ -9,18 +11,39 @@ import curses.panel
 import pyte
 
 from . import actions
+from .comms import Comms
 from .menu import Menu
+from .reader import Reader
+from .render import Renderer
+from .scrollback import HistoryScreen, Scrollback
 
 
 class Terminal(object):
     escape_key = b'\x01'
     menu_key = b'\x1b'
+    # Where key presses come from (stdin).
+    input_fd = 0
+    # Most screen repaints per second (None for a repaint on every read).
+    frame_rate = 30
+    last_frame = 0
+    renderer = None
 
     def __init__(self, port, accept_input=True, log=None):
         self.port = port
         self.accept_input = accept_input
         self.escape_mode = None
         self.log = log
+        self._comms = None
+        self.reader = None
+
+    @property
+    def comms(self):
+        """
+        The device session shared by every action, created when first used.
+        """
+        if self._comms is None:
+            self._comms = Comms(self, silent=True)
+        return self._comms
 
     @property
     def running(self):
@@ -41,6 +64,7 @@ class Terminal(object):
             [
                 ('Upload', actions.browse),
                 ('Remote Browse', actions.remote),
+                ('Scrollback', actions.scrollback),
                 ('Reset uPy', actions.reset),
                 ('Exit uterm', lambda terminal: terminal.close()),
             ])
@@ -61,62 +85,148 @@ class Terminal(object):
             return
         if data == b'\n':
             data = b'\r'
+        self.write(data)
+
+    def write(self, data):
+        """
+        Write data straight to the port, skipping any key handling.
+        """
         self.port.write(data)
 
-    def rx(self, silent=False, readline=False):
+    def start_reader(self, size=1 << 16):
+        """
+        Drain the port on a background thread into a ring buffer of
+        ``size`` bytes, which everything then reads from.
+        """
+        if self.reader:
+            return
+        self.reader = Reader(self.port, size)
+        self.reader.start()
+
+    def stop_reader(self):
+        if self.reader:
+            self.reader.stop()
+            self.reader = None
+
+    def fileno(self):
+        """
+        The file descriptor which is readable when there's incoming data
+        (raises ``AttributeError`` for ports which don't have one, such as on
+        Windows).
+        """
+        if self.reader:
+            return self.reader.fileno()
+        return self.port.fileno()
+
+    def in_waiting(self):
+        if self.reader:
+            return self.reader.in_waiting()
+        return self.port.inWaiting()
+
+    def rx(self, silent=False):
         if not self.running:
             return ''
-        if readline:
-            self.port.timeout = 0.1
-            incoming = self.port.readline()
+        if self.reader:
+            incoming = self.reader.read()
         else:
             waiting = self.port.inWaiting()
-            if not waiting:
-                return ''
-            incoming = self.port.read(waiting)
+            incoming = waiting and self.port.read(waiting)
+        if not incoming:
+            return ''
         if self.log:
             self.log.write(incoming)
+        if self._comms:
+            self._comms.watch(incoming)
         if not silent:
             self.screen_stream.feed(incoming)
-            display = self.screen.display
-            for i in self.screen.dirty:
-                line = display[i].encode('ascii', 'replace')
-                self.window.addstr(i, 0, line)
-            self.screen.dirty.clear()
-            c = self.screen.cursor
-            self.window.move(c.y, c.x)
+            self.render()
         return incoming
 
-    def send_command(self, command):
-        command = command.strip().replace('\n', '\r')
-        self.tx(b'\x03\x05')
-        self.port.flush()
-        line = ''
-        while not line.endswith(b'=== '):
-            line += self.rx(silent=True)
-        if '\r' in command:
-            command += '\r\r\r'
-        command += '\x04'
-        self.tx(b'{}'.format(command))
-        self.port.flush()
-        # Read lines
-        for i in range(command.count('\r')+1):
-            self.rx(silent=True, readline=True)
+    def render(self, force=False):
+        """
+        Repaint the lines which changed since the last frame, unless a frame
+        was painted less than ``1 / frame_rate`` seconds ago (in which case
+        the changes wait for the next frame).
+
+        Returns:
+            bool: whether a frame was painted
+        """
+        now = time.time()
+        if not force and self.frame_rate and (
+                now - self.last_frame < 1.0 / self.frame_rate):
+            return False
+        self.last_frame = now
+        if self.renderer is None:
+            self.renderer = Renderer(self.window)
+        self.renderer.paint(self.screen)
+        return True
+
+    def next_frame(self):
+        """
+        Seconds until changes waiting to be painted are due (``None`` if
+        there aren't any).
+        """
+        screen = getattr(self, 'screen', None)
+        if not screen or not screen.dirty:
+            return None
+        if not self.frame_rate:
+            return 0
+        return max(0, self.last_frame + 1.0 / self.frame_rate - time.time())
+
+    def wait(self, timeout):
+        """
+        Block until there is incoming data to read, or ``timeout`` seconds
+        have passed.
+
+        Returns:
+            bool: whether data is waiting
+        """
+        if not self.running:
+            time.sleep(timeout)
+            return False
+        if self.in_waiting():
+            return True
+        try:
+            fd = self.fileno()
+        except AttributeError:
+            # No file descriptor to select on (e.g. on Windows), so poll.
+            time.sleep(min(timeout, 0.001))
+            return bool(self.in_waiting())
+        return bool(select.select([fd], [], [], timeout)[0])
+
+    def wait_input(self, timeout=None):
+        """
+        Block until there is a key press or incoming data, or ``timeout``
+        seconds have passed (``None`` waits indefinitely).
+
+        Returns:
+            bool: whether there is anything to read
+        """
+        if self.in_waiting():
+            return True
+        fds = [self.input_fd]
+        try:
+            fds.append(self.fileno())
+        except AttributeError:
+            # No file descriptor to select on (e.g. on Windows), so only
+            # wait briefly for keys before polling the port again.
+            timeout = 0.001 if timeout is None else min(timeout, 0.001)
+        return bool(select.select(fds, [], [], timeout)[0])
 
     def loop(self):
         while self.running:
+            self.wait_input(self.next_frame())
             key = ''
-            t = 0
             while True:
                 try:
                     key += self.window.getkey()
-                    t = time.time()
                 except curses.error:
-                    if time.time() - t > 0.0025:
-                        break
+                    break
             if key:
                 self.tx(key.encode())
             self.rx()
+            if self.next_frame() == 0:
+                self.render()
 
     def __call__(self, window):
         # Don't wait for input when calling getch.
@@ -124,10 +234,15 @@ class Terminal(object):
         # Don't interpret escape sequences, we want to send them on.
         window.keypad(0)
         self.window = window
+        if curses.has_colors():
+            curses.use_default_colors()
+        self.renderer = Renderer(window)
 
         # Set up terminal
         y, x = window.getmaxyx()
-        self.screen = pyte.DiffScreen(x-1, y)
+        self.scrollback = Scrollback()
+        self.screen = HistoryScreen(
+            x-1, y, self.scrollback, self.renderer.attribute)
         self.screen_stream = pyte.ByteStream()
         self.screen_stream.attach(self.screen)
         window.addstr(
@@ -146,7 +261,13 @@ class Terminal(object):
     def run(self):
         # Set shorter escape delay.
         os.environ.setdefault('ESCDELAY', '25')
-        curses.wrapper(self)
+        # So curses can display unicode.
+        locale.setlocale(locale.LC_ALL, '')
+        self.start_reader()
+        try:
+            curses.wrapper(self)
+        finally:
+            self.stop_reader()
 
 
 def main():
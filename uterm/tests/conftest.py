@@ -0,0 +1,4 @@
+import sys
+
+# The asyncio interface needs Python 3.5+.
+collect_ignore = ['test_aiocomms.py'] if sys.version_info < (3, 5) else []
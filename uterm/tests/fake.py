@@ -0,0 +1,196 @@
+"""
+A fake MicroPython device for testing the REPL protocols.
+
+It stands in for a :class:`uterm.terminal.Terminal`, executing whatever
+source is sent to it with the local Python interpreter.
+"""
+from __future__ import unicode_literals
+import io
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+import types
+import zlib
+
+from ..comms import Comms
+
+BANNER = b'\r\nMicroPython fake\r\nType "help()" for more information.\r\n'
+RAW_BANNER = b'raw REPL; CTRL-B to exit\r\n>'
+COMPOUND = (b'if ', b'for ', b'while ', b'with ', b'def ', b'try:')
+
+
+class DeflateIO(object):
+    """
+    Stand-in for MicroPython's ``deflate.DeflateIO`` (zlib format only).
+    """
+
+    def __init__(self, stream, format=None, wbits=0):
+        self.stream = stream
+        self.decompressor = zlib.decompressobj()
+        self.pending = b''
+
+    def read(self, size):
+        while len(self.pending) < size:
+            chunk = self.stream.read(64)
+            if not chunk:
+                self.pending += self.decompressor.flush()
+                break
+            self.pending += self.decompressor.decompress(chunk)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+deflate = types.ModuleType(str('deflate'))
+deflate.ZLIB = 1
+deflate.DeflateIO = DeflateIO
+
+
+class FakeDevice(object):
+
+    def __init__(self, raw_paste=True, window=128, modules=None):
+        self.raw_paste = raw_paste
+        self.window = window
+        # Extra (MicroPython only) modules the device provides.
+        self.modules = modules or {}
+        self.namespace = {}
+        self.mode = 'friendly'
+        self.line = b''
+        self.lines = []
+        self.received = 0
+        self.output = b''
+        self.statements = []
+        self._comms = None
+
+    # Terminal interface.
+
+    @property
+    def comms(self):
+        if self._comms is None:
+            self._comms = Comms(self, silent=True)
+        return self._comms
+
+    def tx(self, data):
+        self.write(data)
+
+    def write(self, data):
+        for i in range(len(data)):
+            getattr(self, 'handle_%s' % self.mode)(data[i:i + 1])
+
+    def wait(self, timeout):
+        return bool(self.output)
+
+    def rx(self, silent=False):
+        data, self.output = self.output, b''
+        return data
+
+    # Device modes.
+
+    def handle_friendly(self, char):
+        if char == b'\x01':
+            self.mode = 'raw'
+            self.line = b''
+            self.output += RAW_BANNER
+        elif char == b'\x03':
+            self.line = b''
+            self.lines = []
+        elif char == b'\r':
+            self.output += b'\r\n'
+            if self.lines or self.line.startswith(COMPOUND):
+                self.lines.append(self.line)
+                self.line = b''
+                if self.lines[-1]:
+                    self.output += b'... '
+                    return
+                self.output += self.execute(b'\n'.join(self.lines))[0]
+                self.lines = []
+            else:
+                line, self.line = self.line, b''
+                if line:
+                    self.output += self.execute(line, 'single')[0]
+            self.output += b'>>> '
+        else:
+            self.line += char
+            self.output += char
+
+    def handle_raw(self, char):
+        if self.raw_paste and self.line + char == b'\x05A\x01':
+            self.mode = 'paste'
+            self.line = b''
+            self.received = 0
+            self.output += b'R\x01' + bytes(bytearray(
+                [self.window & 0xff, self.window >> 8]))
+        elif char == b'\x01':
+            self.line = b''
+            self.output += RAW_BANNER
+        elif char == b'\x02':
+            self.mode = 'friendly'
+            self.line = b''
+            self.output += BANNER + b'>>> '
+        elif char == b'\x04':
+            self.output += b'OK'
+            self.run_raw()
+        else:
+            self.line += char
+
+    def handle_paste(self, char):
+        if char == b'\x04':
+            self.mode = 'raw'
+            self.output += b'\x04'
+            self.run_raw()
+            return
+        self.line += char
+        self.received += 1
+        if not self.received % self.window:
+            self.output += b'\x01'
+
+    def run_raw(self):
+        source, self.line = self.line, b''
+        output, error = self.execute(source)
+        self.output += output + b'\x04' + error + b'\x04>'
+
+    def execute(self, source, mode='exec'):
+        self.statements.append(source)
+        stdout = sys.stdout
+        sys.stdout = io.StringIO() if sys.version_info[0] > 2 else io.BytesIO()
+        original = dict(
+            (name, sys.modules.get(name)) for name in self.modules)
+        sys.modules.update(self.modules)
+        error = b''
+        try:
+            exec(compile(source.decode(), '<stdin>', mode), self.namespace)
+        except Exception:
+            error = traceback.format_exc().encode()
+        finally:
+            output, sys.stdout = sys.stdout.getvalue(), stdout
+            for name, module in original.items():
+                if module is None:
+                    del sys.modules[name]
+                else:
+                    sys.modules[name] = module
+        if hasattr(output, 'encode'):
+            output = output.encode()
+        output = output.replace(b'\n', b'\r\n')
+        if mode == 'single':
+            output += error.replace(b'\n', b'\r\n')
+            error = b''
+        return output, error
+
+
+class TempDirMixin(object):
+    """
+    Run each test in a new temporary directory (removed afterwards).
+    """
+
+    def setUp(self):
+        super(TempDirMixin, self).setUp()
+        cwd = os.getcwd()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        os.chdir(self.path)
+        self.addCleanup(os.chdir, cwd)
+
+    def write(self, path, content):
+        with open(path, 'wb') as f:
+            f.write(content)
@@ -1,11 +1,16 @@
 from __future__ import unicode_literals
+import base64
+import os
+import types
 from unittest import TestCase
 try:
     from unittest import mock
 except ImportError:
     import mock
 
-from .. import actions
+from .. import actions, browser
+from ..comms import Comms
+from .fake import FakeDevice, TempDirMixin, deflate
 
 
 class UploaderTest(TestCase):
@@ -15,6 +20,238 @@ class UploaderTest(TestCase):
         self.assertEqual(uploader.name, 'path')
 
 
+class EncodeChunkTest(TestCase):
+
+    def test_text(self):
+        self.assertEqual(actions.encode_chunk(b'print(1)'), b"b'print(1)'")
+
+    def test_binary(self):
+        self.assertEqual(
+            actions.encode_chunk(b'\x00' * 30),
+            b"binascii.a2b_base64('" + b'A' * 40 + b"')")
+
+
+class UploadTest(TempDirMixin, TestCase):
+
+    def setUp(self):
+        super(UploadTest, self).setUp()
+        os.mkdir('local')
+        self.content = bytes(bytearray(range(256))) * 20
+        self.write(os.path.join('local', 'test.py'), self.content)
+
+    def assertUploaded(self):
+        self.assertFalse(os.path.exists('_test.py'))
+        with open('test.py', 'rb') as f:
+            self.assertEqual(f.read(), self.content)
+
+    def test_raw_paste(self):
+        device = FakeDevice()
+        progress = mock.Mock()
+        uploader = actions.Uploader('local/test.py', progress)
+        uploader(device)
+        self.assertUploaded()
+        progress.assert_called_with(1)
+        self.assertTrue(uploader.bytes_per_second)
+        self.assertEqual(device.mode, 'friendly')
+
+    def test_binary_overhead(self):
+        uploader = actions.Uploader('local/test.py')
+        uploader(FakeDevice())
+        self.assertUploaded()
+        # Base64 rather than escaped bytes literals.
+        self.assertLess(uploader.overhead, 1.4)
+
+    def test_encodings(self):
+        for encoding in actions.ENCODINGS:
+            uploader = actions.Uploader('local/test.py', encoding=encoding)
+            uploader(FakeDevice())
+            self.assertUploaded()
+
+    def test_compress(self):
+        device = FakeDevice(modules={'deflate': deflate})
+        uploader = actions.Uploader('local/test.py', compress=True)
+        uploader(device)
+        self.assertUploaded()
+        self.assertFalse(os.path.exists('_test.py.z'))
+        self.assertLess(uploader.overhead, 0.2)
+
+    def test_compress_unsupported(self):
+        device = FakeDevice()
+        uploader = actions.Uploader('local/test.py', compress=True)
+        uploader(device)
+        self.assertUploaded()
+        self.assertGreater(uploader.overhead, 1)
+
+    def test_compress_fallback(self):
+        device = FakeDevice(raw_paste=False, modules={'deflate': deflate})
+        uploader = actions.Uploader('local/test.py', compress=True)
+        uploader(device)
+        self.assertUploaded()
+
+    def test_retransmit(self):
+        device = FakeDevice()
+        execute = device.execute
+        corrupted = []
+
+        def corrupt(source, mode='exec'):
+            if source.startswith(b'_fhw(') and not corrupted:
+                corrupted.append(source)
+                source = source.replace(b'AAEC', b'AAED', 1)
+            return execute(source, mode)
+
+        device.execute = corrupt
+        uploader = actions.Uploader('local/test.py')
+        uploader(device)
+        self.assertUploaded()
+        self.assertEqual(len(corrupted), 1)
+        self.assertIn(corrupted[0], device.statements)
+
+    def test_timeout_resync(self):
+        device = FakeDevice()
+        device.comms.stats.default_timeout = 0.05
+        device.comms.stats.minimum_timeout = 0.05
+        device.comms.stats.code_timeout = 0.05
+        run_raw = device.run_raw
+        dropped = []
+
+        def hang():
+            if device.line.startswith(b'_fhw(') and not dropped:
+                # Never respond, as if the device had stalled.
+                dropped.append(device.line)
+                device.line = b''
+                return
+            run_raw()
+
+        device.run_raw = hang
+        with mock.patch.object(
+                device.comms, 'enter_raw',
+                wraps=device.comms.enter_raw) as enter_raw:
+            actions.Uploader('local/test.py')(device)
+        self.assertUploaded()
+        self.assertEqual(len(dropped), 1)
+        # Once to start, then to resync after the timeout.
+        self.assertEqual(enter_raw.call_count, 2)
+
+    def test_device_error(self):
+        device = FakeDevice()
+        execute = device.execute
+
+        def fail(source, mode='exec'):
+            if source.startswith(b'_fhw('):
+                source = b'raise OSError(28)'
+            return execute(source, mode)
+
+        device.execute = fail
+        self.assertRaises(
+            ValueError, actions.Uploader('local/test.py'), device)
+        # Not retried, as only CRC mismatches are.
+        self.assertEqual(device.statements.count(b'raise OSError(28)'), 1)
+
+    def test_resume(self):
+        # Leftover from an interrupted upload.
+        with open('_test.py', 'wb') as f:
+            f.write(self.content[:3000])
+        device = FakeDevice()
+        uploader = actions.Uploader('local/test.py')
+        uploader(device)
+        self.assertUploaded()
+        writes = [s for s in device.statements if s.startswith(b'_fhw(')]
+        # Only the first (verified) block was skipped.
+        self.assertEqual(len(writes), 2)
+
+    def test_resume_mismatch(self):
+        with open('_test.py', 'wb') as f:
+            f.write(b'x' * 3000)
+        device = FakeDevice()
+        uploader = actions.Uploader('local/test.py')
+        uploader(device)
+        self.assertUploaded()
+        writes = [s for s in device.statements if s.startswith(b'_fhw(')]
+        self.assertEqual(len(writes), 3)
+
+    def test_failure_leaves_raw(self):
+        device = FakeDevice()
+        uploader = actions.Uploader('local/test.py')
+        with mock.patch.object(
+                uploader, 'write_raw', side_effect=ValueError('Timeout')):
+            self.assertRaises(ValueError, uploader, device)
+        self.assertFalse(device.comms.raw)
+        self.assertEqual(device.mode, 'friendly')
+
+    def test_no_crc32(self):
+        binascii = types.ModuleType(str('binascii'))
+        binascii.a2b_base64 = base64.b64decode
+        with open('_test.py', 'wb') as f:
+            f.write(self.content[:3000])
+        device = FakeDevice(modules={'binascii': binascii})
+        uploader = actions.Uploader('local/test.py')
+        uploader(device)
+        self.assertUploaded()
+        writes = [s for s in device.statements if s.startswith(b'_fhw(')]
+        # Everything was written, unverified.
+        self.assertEqual(len(writes), 3)
+        self.assertIn(b', None, 0)', writes[0])
+        self.assertFalse(device.comms.crc32)
+
+    def test_fallback(self):
+        device = FakeDevice(raw_paste=False)
+        uploader = actions.Uploader('local/test.py')
+        uploader(device)
+        self.assertUploaded()
+        self.assertIn(b'_fhw(', device.statements[-10])
+
+
+class BatchUploadTest(TempDirMixin, TestCase):
+
+    def setUp(self):
+        super(BatchUploadTest, self).setUp()
+        os.makedirs(os.path.join('local', 'lib'))
+        for name, content in (
+                ('main.py', b'import lib'), ('big.py', b'#' * 3000),
+                ('lib/small.py', b'x = 1'), ('lib/notes.txt', b'')):
+            self.write(os.path.join('local', name), content)
+
+    def test_upload_files(self):
+        py_browser = mock.Mock()
+        py_browser.file_match.side_effect = lambda name: name.endswith('.py')
+        objs = [browser.Dir('local/lib', factory=py_browser),
+                browser.File('local/main.py', factory=py_browser)]
+        self.assertEqual(
+            actions.upload_files(py_browser, objs),
+            [(os.path.join('local/lib', 'small.py'), 'lib/small.py'),
+             ('local/main.py', 'main.py')])
+
+    def test_call(self):
+        device = FakeDevice()
+        progress = mock.Mock()
+        files = [('local/main.py', 'main.py'), ('local/big.py', 'big.py'),
+                 ('local/lib/small.py', 'lib/small.py')]
+        uploader = actions.BatchUploader(files, progress)
+        self.assertEqual(
+            [name for _, name in uploader.files],
+            ['lib/small.py', 'big.py', 'main.py'])
+        with mock.patch.object(
+                device.comms, 'enter_raw',
+                wraps=device.comms.enter_raw) as enter_raw:
+            uploader(device)
+        # A single session was used.
+        self.assertEqual(enter_raw.call_count, 1)
+        for path, name in files:
+            with open(path, 'rb') as local, open(name, 'rb') as remote:
+                self.assertEqual(local.read(), remote.read())
+        progress.assert_called_with(1)
+        self.assertTrue(uploader.bytes_per_second)
+        self.assertEqual(device.mode, 'friendly')
+
+    def test_failure_leaves_raw(self):
+        device = FakeDevice()
+        uploader = actions.BatchUploader([('local/main.py', 'main.py')])
+        with mock.patch.object(
+                actions.Uploader, 'upload', side_effect=ValueError('Timeout')):
+            self.assertRaises(ValueError, uploader, device)
+        self.assertEqual(device.mode, 'friendly')
+
+
 class BrowseTest(TestCase):
 
     @mock.patch('uterm.actions.curses')
@@ -31,6 +268,7 @@ class ResetTest(TestCase):
     def test_call(self):
         mock_terminal = mock.Mock()
         mock_terminal.rx.return_value = b'>>> '
+        mock_terminal.comms = Comms(mock_terminal)
         actions.reset(mock_terminal)
         mock_terminal.tx.assert_called_with(b'machine.reset()\r')
 
@@ -47,6 +285,7 @@ class RemoteTest(TestCase):
     def test_call(self, mock_browser, *args):
         mock_terminal = mock.Mock()
         mock_terminal.rx.return_value = b'>>> '
+        mock_terminal.comms = Comms(mock_terminal)
         mock_browser.uPyBrowser().run.return_value = ('NOOP', None)
         mock_terminal.window.getmaxyx.return_value = (80, 24)
         actions.remote(mock_terminal)
@@ -0,0 +1,122 @@
+from __future__ import unicode_literals
+import base64
+import os
+import shutil
+import types
+from unittest import TestCase
+
+from .. import actions, agent
+from ..sync import Sync
+from .fake import FakeDevice, TempDirMixin
+
+
+def agent_module(version=agent.VERSION):
+    module = types.ModuleType(str(agent.NAME))
+    exec(agent.SOURCE, module.__dict__)
+    module.VERSION = version
+    return module
+
+
+class AgentTest(TempDirMixin, TestCase):
+
+    def setUp(self):
+        super(AgentTest, self).setUp()
+        os.makedirs(os.path.join('d', 'sub'))
+        self.write('d/a.txt', b'hello world')
+        self.module = agent_module()
+
+    def test_not_installed(self):
+        device = FakeDevice()
+        self.assertFalse(agent.installed(device.comms))
+        del device.statements[:]
+        self.assertFalse(agent.installed(device.comms))
+        self.assertEqual(device.statements, [])
+        # The listing helpers are sent in lines which fit the device's
+        # input buffer.
+        tree = agent.tree(device.comms, 'd')
+        self.assertEqual(
+            sorted(entry[:2] for entry in tree['d']),
+            [['a.txt', False], ['sub', True]])
+        for statement in device.statements:
+            self.assertLessEqual(len(statement), device.comms.line_bytes)
+
+    def test_outdated(self):
+        device = FakeDevice(modules={agent.NAME: agent_module(0)})
+        self.assertFalse(agent.installed(device.comms))
+
+    def test_installed(self):
+        device = FakeDevice(modules={agent.NAME: self.module})
+        self.assertTrue(agent.installed(device.comms))
+        self.assertIn(agent.NAME, device.comms.imports)
+
+    def test_functions(self):
+        self.assertEqual(
+            sorted(entry[:2] for entry in self.module.ls('d')),
+            [['a.txt', False], ['sub', True]])
+        self.assertEqual(self.module.stat('d/a.txt')[:2], [False, 11])
+        self.assertIsNone(self.module.stat('missing'))
+        self.assertEqual(
+            self.module.walk('d'), {'d/a.txt': False, 'd/sub': True})
+        tree = self.module.tree('d', 1)
+        self.assertEqual(sorted(tree), ['d', 'd/sub'])
+        self.assertEqual(tree['d/sub'], [])
+        self.assertEqual(self.module.tree('missing'), {'missing': None})
+        # An empty path is the current directory.
+        self.assertEqual(self.module.walk('', 0), {'d': True})
+        hashes = self.module.hashes('d')
+        self.assertEqual(hashes['d'], None)
+        self.assertEqual(hashes['d/sub'], None)
+        self.assertEqual(len(hashes['d/a.txt']), 64)
+        self.assertEqual(self.module.hashes('missing'), {})
+        self.assertEqual(len(self.module.crcs('d/a.txt', 4)), 3)
+        self.assertEqual(
+            base64.b64decode(self.module.read('d/a.txt', 6, 3)), b'wor')
+        self.module.rmtree('d')
+        self.assertFalse(os.path.exists('d'))
+
+    def test_upload(self):
+        device = FakeDevice(modules={agent.NAME: self.module})
+        self.assertTrue(actions.Uploader('d/a.txt')(device))
+        with open('a.txt', 'rb') as f:
+            self.assertEqual(f.read(), b'hello world')
+        sources = b'\n'.join(device.statements)
+        self.assertIn(b'Writer(', sources)
+        self.assertNotIn(b'def _fhw', sources)
+
+    def test_upload_binary(self):
+        content = bytes(bytearray(range(256))) * 4
+        self.write('d/b.bin', content)
+        for raw_paste in (True, False):
+            device = FakeDevice(
+                raw_paste=raw_paste, modules={agent.NAME: self.module})
+            self.assertTrue(actions.Uploader('d/b.bin')(device))
+            with open('b.bin', 'rb') as f:
+                self.assertEqual(f.read(), content)
+            os.remove('b.bin')
+
+    def test_sync(self):
+        device = FakeDevice(modules={agent.NAME: self.module})
+        sync = Sync('d', 'remote')
+        sync(device)
+        del device.statements[:]
+        sync(device)
+        self.assertEqual(sync.unchanged, ['remote/a.txt'])
+        self.assertEqual(len(device.statements), 1)
+        self.assertIn(b'.hashes(', device.statements[0])
+
+    def test_prune(self):
+        device = FakeDevice(modules={agent.NAME: self.module})
+        Sync('d', 'remote')(device)
+        shutil.rmtree('d/sub')
+        sync = Sync('d', 'remote', prune=True)
+        sync(device)
+        self.assertEqual(sync.removed, ['remote/sub'])
+        self.assertFalse(os.path.exists('remote/sub'))
+
+    def test_install(self):
+        device = FakeDevice()
+        self.assertFalse(agent.installed(device.comms))
+        self.assertTrue(actions.install_agent(device, path='lib/_uterm.py'))
+        with open('lib/_uterm.py') as f:
+            self.assertEqual(f.read(), agent.SOURCE)
+        self.assertEqual(device.comms.agent_version, agent.VERSION)
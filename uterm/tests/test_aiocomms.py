@@ -0,0 +1,77 @@
+import asyncio
+import os
+from unittest import TestCase
+
+from ..aiocomms import AsyncComms
+from .fake import FakeDevice
+
+
+class PipeDevice(FakeDevice):
+    """
+    A fake device with a file descriptor which is readable while it has
+    output waiting.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PipeDevice, self).__init__(*args, **kwargs)
+        self.read_fd, self.write_fd = os.pipe()
+
+    def fileno(self):
+        return self.read_fd
+
+    def write(self, data):
+        super(PipeDevice, self).write(data)
+        if self.output:
+            os.write(self.write_fd, b'.')
+
+    def rx(self, silent=False):
+        if self.output:
+            os.read(self.read_fd, 1024)
+        return super(PipeDevice, self).rx(silent)
+
+
+class AsyncCommsTest(TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_requests(self, device):
+        comms = AsyncComms(device.comms, loop=self.loop)
+        futures = [
+            comms.send('x = 2'),
+            comms.json('[x, x * 2]'),
+            comms.json_batch(['x', '1 / 0']),
+            comms.send('print(x)'),
+        ]
+        results = self.loop.run_until_complete(asyncio.gather(*futures))
+        self.assertEqual(results[:2], ['', [2, 4]])
+        self.assertEqual(results[2][0], 2)
+        self.assertIsInstance(results[2][1], ValueError)
+        self.assertEqual(results[3], '2')
+        self.assertIsNone(comms.fd)
+
+    def test_poll(self):
+        self.run_requests(FakeDevice())
+
+    def test_reader(self):
+        device = PipeDevice()
+        self.run_requests(device)
+        os.close(device.read_fd)
+        os.close(device.write_fd)
+
+    def test_timeout(self):
+        device = FakeDevice()
+        device.write = lambda data: None
+        comms = AsyncComms(device.comms, loop=self.loop)
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(comms.send('1', timeout=0.01))
+
+    def test_import_module(self):
+        comms = AsyncComms(FakeDevice().comms, loop=self.loop)
+        futures = [comms.import_module('missing'), comms.import_module('os')]
+        self.loop.run_until_complete(asyncio.gather(*futures))
+        # Only the import which worked is remembered.
+        self.assertEqual(comms.comms.imports, ['os'])
@@ -0,0 +1,66 @@
+from __future__ import unicode_literals
+import os
+from unittest import TestCase
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from .. import bench
+from ..comms import Comms
+from .fake import FakeDevice, TempDirMixin, deflate
+
+
+class UploadBenchTest(TempDirMixin, TestCase):
+
+    def setUp(self):
+        super(UploadBenchTest, self).setUp()
+        os.mkdir('local')
+        self.write('local/test.py', b'print("hello world")\n' * 100)
+        # The device's own copy.
+        self.write('test.py', b'print(1)')
+
+    def test_upload(self):
+        device = FakeDevice(modules={'deflate': deflate})
+        results = bench.upload(device, 'local/test.py', repeat=1)
+        self.assertEqual([name for name, _, _ in results],
+                         ['plain', 'compressed'])
+        self.assertLess(results[1][2], results[0][2])
+        self.assertEqual(sorted(os.listdir('.')), ['local', 'test.py'])
+        with open('test.py', 'rb') as f:
+            self.assertEqual(f.read(), b'print(1)')
+
+    def test_upload_failed(self):
+        # Left by an interrupted compressed upload.
+        self.write('__uterm_bench.z', b'')
+        device = FakeDevice()
+        with mock.patch.object(
+                bench, 'Uploader', side_effect=ValueError('Timeout')):
+            self.assertRaises(
+                ValueError, bench.upload, device, 'local/test.py')
+        self.assertEqual(sorted(os.listdir('.')), ['local', 'test.py'])
+
+
+class SendOverheadTest(TestCase):
+
+    def test_same_output(self):
+        output = b'1\r\n2\r\n'
+        self.assertEqual(
+            bench.screen_send(bench.EchoTerminal(output), b'x'), 'x\n1\n2\n')
+        self.assertEqual(
+            Comms(bench.EchoTerminal(output)).send(b'x'), '1\n2')
+
+    def test_send_overhead(self):
+        before, after = bench.send_overhead(calls=5)
+        self.assertGreater(before, 0)
+        self.assertGreater(after, 0)
+
+
+class RenderThroughputTest(TestCase):
+
+    def test_render_throughput(self):
+        uncapped = bench.render_throughput(None, size=1 << 14)
+        capped = bench.render_throughput(1, size=1 << 14)
+        self.assertGreater(uncapped[0], 0)
+        # Only the final forced frame (and possibly the first) is painted.
+        self.assertLess(capped[1], uncapped[1])
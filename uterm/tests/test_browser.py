@@ -2,7 +2,12 @@ try:
     from unittest import mock
 except ImportError:
     import mock
-from uterm.browser import OSBrowser
+import curses
+
+from uterm.browser import (
+    OSBrowser, PathIndex, PyBrowser, fuzzy_score, uPyBrowser)
+from uterm.comms import Comms
+from uterm.tests.fake import FakeDevice
 
 
 def fake_isdir(name):
@@ -22,16 +27,181 @@ def test_osbrowser_is_container(os_path):
     assert not browser.is_container('Banana')
 
 
-@mock.patch('os.listdir')
-def test_osbrowser_list_container(os_listdir):
-    files = ['a.py', 'b.py']
-    os_listdir.return_value = files
-    browser = OSBrowser()
-    assert browser.list_container('') == files
+def test_osbrowser_list_container(tmpdir):
+    tmpdir.join('a.py').write('')
+    tmpdir.join('b.py').write('')
+    browser = OSBrowser(str(tmpdir))
+    assert sorted(browser.list_container(str(tmpdir))) == ['a.py', 'b.py']
+    # Types come from the scan, rather than another stat.
+    with mock.patch('os.path.isdir') as isdir:
+        assert not browser.is_container(str(tmpdir.join('a.py')))
+    isdir.assert_not_called()
 
 
-@mock.patch('os.listdir')
-def test_osbrowser_list_container_failed(os_listdir):
-    os_listdir.side_effect = OSError
-    browser = OSBrowser()
-    assert browser.list_container('') is None
+def test_osbrowser_list_container_failed(tmpdir):
+    browser = OSBrowser(str(tmpdir))
+    assert browser.list_container(str(tmpdir.join('missing'))) is None
+
+
+def wait_scans(browser):
+    for scan in list(browser.scans.values()):
+        scan.done.wait()
+
+
+def test_osbrowser_background_scan(tmpdir):
+    for i in range(20):
+        tmpdir.join('%d.py' % i).write('')
+    with mock.patch.object(OSBrowser, 'scan_timeout', 0):
+        browser = OSBrowser(str(tmpdir))
+    wait_scans(browser)
+    assert not browser.loading
+    browser.update()
+    assert len(browser.rows) == 21
+    # With nothing new, the rows aren't walked.
+    browser.rows = mock.NonCallableMock()
+    assert not browser.update()
+
+
+def test_pybrowser_prunes_empty(tmpdir):
+    tmpdir.mkdir('docs').join('readme.txt').write('')
+    tmpdir.mkdir('lib').join('a.py').write('')
+    tmpdir.join('main.py').write('')
+    browser = PyBrowser(str(tmpdir))
+    assert len(browser.rows) == 4
+    # Drawing the subdirectories' icons lists them.
+    for obj, _ in browser.rows:
+        obj.icon()
+    wait_scans(browser)
+    assert browser.update()
+    assert [obj.nice_name for obj, _ in browser.rows[1:]] == [
+        'lib', 'main.py']
+
+
+def test_expand_splices_rows(tmpdir):
+    tmpdir.mkdir('a').mkdir('b').join('c.py').write('')
+    tmpdir.join('d.py').write('')
+    browser = OSBrowser(str(tmpdir))
+
+    def names():
+        return [(obj.nice_name, depth) for obj, depth in browser.rows]
+
+    assert names() == [(tmpdir.basename, 0), ('a', 1), ('d.py', 1)]
+    browser.expand(1)
+    assert names()[1:] == [('a', 1), ('b', 2), ('d.py', 1)]
+    browser.expand(2)
+    assert names()[1:] == [('a', 1), ('b', 2), ('c.py', 3), ('d.py', 1)]
+    browser.expand(1, False)
+    assert names()[1:] == [('a', 1), ('d.py', 1)]
+    # Expanding again restores the expanded subdirectory.
+    browser.expand(1)
+    assert len(browser.rows) == 5
+
+
+@mock.patch.multiple(
+    curses, LINES=4, COLS=20, create=True, init_pair=mock.DEFAULT,
+    color_pair=mock.DEFAULT)
+def test_run_draws_viewport(tmpdir, **kwargs):
+    for i in range(10):
+        tmpdir.join('%d.py' % i).write('')
+    browser = OSBrowser(str(tmpdir))
+    index = (browser.initial_index + 1) % len(browser.rows)
+    stdscr = mock.Mock()
+    stdscr.getch.side_effect = [curses.KEY_DOWN, 27]
+    assert browser.run(stdscr) == ('CANCEL', browser.rows[index][0])
+    # Only the rows on screen are drawn, each time.
+    assert stdscr.addstr.call_count == 6
+    stdscr.clear.assert_called_once_with()
+
+
+# uPyBrowser
+
+def test_upybrowser_child_names(tmpdir):
+    tmpdir.mkdir('lib')
+    tmpdir.join('main.py').write('')
+    tmpdir.join('lib').join('a.py').write('abc')
+    device = FakeDevice()
+    comms = Comms(device)
+    browser = uPyBrowser(comms, name=str(tmpdir))
+    del device.statements[:]
+    browser.reset()
+    assert browser.base.kidnames == [
+        str(tmpdir.join('lib')), str(tmpdir.join('main.py'))]
+    assert [kid.container for kid in browser.base.children()] == [
+        True, False]
+    # The subdirectory was prefetched with the listing.
+    lib = browser.base.children()[0]
+    assert lib.kidnames == [str(tmpdir.join('lib').join('a.py'))]
+    assert browser.stat_cache[lib.kidnames[0]][0] == 3
+    assert len(device.statements) == 1
+
+
+def test_upybrowser_missing(tmpdir):
+    browser = uPyBrowser(Comms(FakeDevice()), name=str(tmpdir))
+    assert browser.list_container(str(tmpdir.join('missing'))) is None
+    assert not browser.is_container(str(tmpdir.join('missing')))
+
+
+# Searching
+
+def test_path_index():
+    index = PathIndex([
+        ('lib/util.py', False), ('main.py', False), ('lib', True),
+        ('lib/umqtt/robust.py', False)])
+    assert [path for path, _ in index.search('ut', 10)] == [
+        'lib/util.py', 'lib/umqtt/robust.py']
+    # Extending the query only checks the previous matches.
+    assert len(index.search('uti', 10)) == 1
+    assert index.matches == [0]
+    assert len(index.search('u', 10)) == 2
+    assert index.search('', 2) == [('lib/util.py', False), ('main.py', False)]
+    assert index.search('zz', 10) == []
+
+
+def test_path_index_budget():
+    index = PathIndex([('a/b/x.py', False), ('x.py', False), ('y.py', False)])
+    index.budget = 2
+    # Only the shortest paths were checked.
+    assert index.search('x', 10) == [('x.py', False)]
+    assert index.checked == 1
+    # The next keystroke catches up the rest.
+    assert index.search('x.', 10) == [('x.py', False), ('a/b/x.py', False)]
+    assert index.search('x', 10) == [('x.py', False)]
+
+
+def test_fuzzy_score():
+    assert fuzzy_score('mp', 'main.py') > fuzzy_score('mp', 'mxxxp')
+    assert fuzzy_score('ab', 'xa/xb') < fuzzy_score('ab', 'a/b')
+    assert fuzzy_score('ba', 'ab') is None
+
+
+@mock.patch.multiple(
+    curses, LINES=10, COLS=40, create=True, init_pair=mock.DEFAULT,
+    color_pair=mock.DEFAULT)
+def test_run_search(tmpdir, **kwargs):
+    tmpdir.mkdir('lib').mkdir('deep').join('needle.py').write('')
+    tmpdir.join('main.py').write('')
+    tmpdir.join('readme.txt').write('')
+    browser = PyBrowser(str(tmpdir))
+    stdscr = mock.Mock()
+    keys = [ord('/')] + [ord(char) for char in 'ndl'] + [ord('\n')]
+    stdscr.getch.side_effect = keys
+    action, obj = browser.run(stdscr)
+    assert action == 'SELECT'
+    assert obj.name == str(tmpdir.join('lib').join('deep').join('needle.py'))
+    assert obj.nice_name == 'lib/deep/needle.py'
+    stdscr.addstr.assert_any_call(9, 0, '/ndl')
+    # Only Python files are indexed.
+    assert all(
+        path.endswith('.py') or container
+        for path, container in browser.path_index.search('', 100))
+
+
+def test_upybrowser_search(tmpdir):
+    tmpdir.mkdir('lib').join('util.py').write('')
+    device = FakeDevice()
+    browser = uPyBrowser(Comms(device), name=str(tmpdir))
+    del device.statements[:]
+    with mock.patch.object(curses, 'LINES', 10, create=True):
+        browser.search('util')
+    assert [obj.nice_name for obj, _ in browser.results] == ['lib/util.py']
+    assert len(device.statements) == 1
@@ -0,0 +1,140 @@
+from __future__ import unicode_literals
+import os
+import types
+from unittest import TestCase
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from .. import actions, agent
+from ..browser import uPyBrowser
+from ..cache import DeviceCache, local_hash
+from ..sync import Sync
+from .fake import FakeDevice, TempDirMixin
+from .test_agent import agent_module
+
+machine = types.ModuleType(str('machine'))
+machine.unique_id = lambda: b'\x01\x02'
+
+
+class CacheTest(TempDirMixin, TestCase):
+
+    def setUp(self):
+        super(CacheTest, self).setUp()
+        os.makedirs(os.path.join('local', 'lib'))
+        os.makedirs(os.path.join('remote', 'lib'))
+        self.write('local/main.py', b'import lib.util')
+        self.write('local/lib/util.py', b'print(1)')
+        self.write('remote/boot.py', b'')
+        self.remote = os.path.join(self.path, 'remote')
+        patcher = mock.patch.multiple(
+            DeviceCache, directory=os.path.join(self.path, 'cache'),
+            root=self.remote)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def device(self):
+        """
+        A new session with the device.
+        """
+        return FakeDevice(modules={'machine': machine})
+
+    def statements(self, device, function):
+        return [
+            source for source in device.statements
+            if function.encode() in source]
+
+    def test_no_unique_id(self):
+        self.assertIsNone(DeviceCache.open(FakeDevice().comms))
+
+    def test_browse(self):
+        device = self.device()
+        browser = uPyBrowser(device.comms, name=self.remote)
+        self.assertEqual(len(browser.base.children()), 2)
+        browser.cache.save()
+        self.assertEqual(
+            os.listdir('cache'), ['{}.json'.format('0102')])
+
+        device = self.device()
+        browser = uPyBrowser(device.comms, name=self.remote)
+        self.assertEqual(
+            [kid.nice_name for kid in browser.base.children()],
+            ['lib', 'boot.py'])
+        self.assertEqual(self.statements(device, "'tree'"), [])
+
+    def test_changed(self):
+        device = self.device()
+        uPyBrowser(device.comms, name=self.remote).cache.save()
+        self.write('remote/new.py', b'')
+
+        device = self.device()
+        browser = uPyBrowser(device.comms, name=self.remote)
+        self.assertEqual(len(browser.base.children()), 3)
+        self.assertEqual(len(self.statements(device, "'tree'")), 1)
+
+    def test_sync(self):
+        remote = os.path.join(self.remote, 'app')
+        Sync('local', remote)(self.device())
+
+        device = self.device()
+        sync = Sync('local', remote)
+        sync(device)
+        self.assertEqual(len(sync.unchanged), 2)
+        # The hashes came from the cache, which the first sync updated.
+        self.assertEqual(self.statements(device, 'hashes'), [])
+        self.assertEqual(self.statements(device, '_h('), [])
+
+        self.write('local/lib/util.py', b'print(2)')
+        sync(self.device())
+        self.assertEqual(sync.uploaded, [remote + '/lib/util.py'])
+
+    def test_sync_agent(self):
+        remote = os.path.join(self.remote, 'app')
+        modules = {'machine': machine, agent.NAME: agent_module()}
+        Sync('local', remote)(FakeDevice(modules=modules))
+
+        device = FakeDevice(modules=modules)
+        self.assertIsNotNone(agent.fingerprint(device.comms, self.remote))
+        sync = Sync('local', remote)
+        sync(device)
+        self.assertEqual(len(sync.unchanged), 2)
+        self.assertEqual(self.statements(device, 'hashes'), [])
+
+    @mock.patch('uterm.actions.curses')
+    @mock.patch('uterm.actions.browser')
+    def test_browse_upload(self, mock_browser, *args):
+        remote = os.path.join(self.remote, 'app')
+        Sync('local', remote)(self.device())
+        main = os.path.join(self.path, 'local', 'main.py')
+        self.write(main, b'import lib')
+        os.chdir(remote)
+
+        terminal = mock.Mock(comms=self.device().comms)
+        terminal.window.getmaxyx.return_value = (24, 80)
+        obj = mock.Mock(container=False)
+        obj.name = main
+        mock_browser.PyBrowser().marked = []
+        mock_browser.PyBrowser().run.return_value = ('SELECT', obj)
+        actions.browse(terminal)
+
+        cache = DeviceCache.open(self.device().comms)
+        self.assertEqual(
+            cache.remote_hashes(remote)[remote + '/main.py'],
+            local_hash(main))
+
+    def test_updates(self):
+        cache = DeviceCache.open(self.device().comms)
+        cache.listings = {'/': [['lib', True, 0, 0]], '/lib': []}
+        cache.hashed = ['/']
+        cache.uploaded('/lib/a/b.py', 'local/main.py')
+        self.assertEqual(cache.listings['/lib'], [['a', True, 0, 0]])
+        self.assertEqual(cache.listings['/lib/a'], [['b.py', False, 15, 0]])
+        self.assertIsNone(cache.hashes['/lib/a'])
+        self.assertEqual(len(cache.hashes['/lib/a/b.py']), 64)
+        self.assertEqual(
+            sorted(cache.remote_hashes('/lib')), ['/lib/a', '/lib/a/b.py'])
+        cache.removed('/lib/a')
+        self.assertEqual(cache.listings, {'/': [['lib', True, 0, 0]],
+                                          '/lib': []})
+        self.assertEqual(cache.hashes, {})
@@ -1,11 +1,13 @@
 from __future__ import unicode_literals
+import time
 from unittest import TestCase
 try:
     from unittest import mock
 except ImportError:
     import mock
 
-from ..comms import Comms
+from ..comms import Comms, LinkStats
+from .fake import FakeDevice
 
 
 class CommsTest(TestCase):
@@ -29,3 +31,226 @@ class CommsTest(TestCase):
         mock_terminal.rx.side_effect = (None, None, b'>>> ')
         comms = Comms(mock_terminal)
         comms.send('test')
+
+    def test_send_output(self):
+        comms = Comms(FakeDevice())
+        self.assertEqual(comms.send('x = 1'), '')
+        # Output isn't limited to a screenful.
+        output = comms.send('for i in range(100): print(i)\r')
+        self.assertEqual(output.splitlines(), [str(i) for i in range(100)])
+
+    def test_json(self):
+        comms = Comms(FakeDevice())
+        self.assertEqual(comms.json('{"a": [1, 2]}'), {'a': [1, 2]})
+
+    def test_json_batch(self):
+        device = FakeDevice()
+        comms = Comms(device)
+        results = comms.json_batch(['1 + 1', '1 / 0', '"a"'])
+        self.assertEqual(results[0], 2)
+        self.assertIsInstance(results[1], ValueError)
+        self.assertIn('ZeroDivisionError', str(results[1]))
+        self.assertEqual(results[2], 'a')
+        # Only the batch itself is sent the second time.
+        del device.statements[:]
+        comms.json_batch(['1', '2'])
+        self.assertEqual(len(device.statements), 1)
+
+    def test_execute_long(self):
+        device = FakeDevice()
+        comms = Comms(device)
+        source = 'x = %r\ny = len(x)\nprint(y)' % ('\x00\n' * 200)
+        self.assertEqual(comms.execute(source), '400')
+        self.assertGreater(len(device.statements), 1)
+        for statement in device.statements:
+            self.assertLessEqual(len(statement), comms.line_bytes)
+
+    def test_json_batch_split(self):
+        device = FakeDevice()
+        comms = Comms(device)
+        comms.json_batch(['1'])
+        del device.statements[:]
+        expressions = ['len(%r)' % ('x' * i) for i in range(40)]
+        self.assertEqual(comms.json_batch(expressions), list(range(40)))
+        # Split into lines which fit the device's input buffer.
+        self.assertGreater(len(device.statements), 1)
+        for statement in device.statements:
+            self.assertLessEqual(len(statement), comms.line_bytes)
+        # The raw REPL takes the whole batch at once.
+        comms.enter_raw()
+        del device.statements[:]
+        self.assertEqual(comms.json_batch(expressions), list(range(40)))
+        self.assertEqual(len(device.statements), 1)
+
+
+class WatchTest(TestCase):
+
+    def test_soft_reboot(self):
+        comms = Comms(mock.Mock())
+        comms.imports = ['os']
+        comms.watch(b'MPY: soft reboot\r\n')
+        self.assertEqual(comms.imports, [])
+
+    def test_split_banner(self):
+        comms = Comms(mock.Mock())
+        comms.imports = ['os']
+        comms.watch(b'\r\nMicroPy')
+        self.assertEqual(comms.imports, ['os'])
+        comms.watch(b'thon v1.9 on 2017-01-01; ESP module\r\n')
+        self.assertEqual(comms.imports, [])
+
+    def test_leaving_raw(self):
+        comms = Comms(mock.Mock())
+        comms.imports = ['os']
+        comms.raw = True
+        comms.watch(b'\r\nMicroPython v1.9 on 2017-01-01; ESP module')
+        comms.raw = False
+        comms.watch(b'\r\n>>> ')
+        self.assertEqual(comms.imports, ['os'])
+
+
+class RawTest(TestCase):
+
+    def test_raw_paste(self):
+        device = FakeDevice()
+        comms = Comms(device)
+        comms.enter_raw()
+        self.assertEqual(comms.raw_exec('print(1 + 1)'), b'2\r\n')
+        self.assertTrue(comms.raw_paste)
+        # Larger than the flow control window.
+        source = 'x = %r' % ('x' * 1000)
+        self.assertEqual(comms.raw_exec(source + ';print(len(x))'),
+                         b'1000\r\n')
+        comms.exit_raw()
+        self.assertEqual(device.mode, 'friendly')
+
+    def test_raw_without_paste(self):
+        device = FakeDevice(raw_paste=False)
+        comms = Comms(device)
+        comms.enter_raw()
+        self.assertEqual(comms.raw_exec('print(1 + 1)'), b'2\r\n')
+        self.assertFalse(comms.raw_paste)
+        self.assertEqual(comms.raw_exec('print(3)'), b'3\r\n')
+
+    def test_raw_error(self):
+        comms = Comms(FakeDevice())
+        comms.enter_raw()
+        with self.assertRaises(ValueError):
+            comms.raw_exec('1 / 0')
+
+
+class PipelineTest(TestCase):
+
+    def test_outputs(self):
+        comms = Comms(FakeDevice())
+        results = list(comms.pipeline(
+            ['x = 1', 'print(x + 1)', 'print("a\\nb")']))
+        self.assertEqual(
+            results, [(b'x = 1', ''), (b'print(x + 1)', '2'),
+                      (b'print("a\\nb")', 'a\nb')])
+
+    def test_error(self):
+        comms = Comms(FakeDevice())
+        with self.assertRaises(ValueError) as cm:
+            list(comms.pipeline(['x = 1', '1 / 0', 'x = 2']))
+        self.assertIn('1 / 0', str(cm.exception))
+
+    def test_window(self):
+        events = []
+        mock_terminal = mock.Mock()
+        mock_terminal.tx.side_effect = lambda data: events.append('tx')
+
+        def rx(silent):
+            events.append('rx')
+            return b'x\r\n>>> '
+
+        mock_terminal.rx.side_effect = rx
+        comms = Comms(mock_terminal)
+        del events[:]
+        list(comms.pipeline(['x'] * 5, window=2))
+        self.assertEqual(events[:3], ['tx', 'tx', 'rx'])
+        self.assertEqual(events.count('tx'), 5)
+
+
+class TrickleTerminal(object):
+    """
+    Terminal stand-in which sends a response one byte at a time.
+    """
+
+    def __init__(self, response, delay=0.01):
+        self.response = response
+        self.delay = delay
+
+    def tx(self, data):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.delay))
+        return bool(self.response)
+
+    def rx(self, silent=False):
+        data, self.response = self.response[:1], self.response[1:]
+        return data
+
+
+class TimeoutTest(TestCase):
+
+    def test_link_stats(self):
+        stats = LinkStats(baudrate=9600)
+        self.assertEqual(stats.timeout(), stats.default_timeout)
+        stats.latency = 0.01
+        self.assertEqual(stats.timeout(), stats.minimum_timeout)
+        self.assertEqual(stats.timeout(code=True), stats.code_timeout)
+        # 960 bytes per second over the wire.
+        self.assertEqual(stats.timeout(960), stats.minimum_timeout + 2)
+        stats.measure_throughput(480, 1)
+        self.assertEqual(stats.rate, 480)
+        stats.latency = 1
+        self.assertEqual(stats.timeout(), stats.latency_factor)
+
+    def test_measured(self):
+        comms = Comms(FakeDevice())
+        comms.send('for i in range(100): print(i)\r')
+        self.assertIsNotNone(comms.stats.latency)
+        self.assertGreater(comms.stats.received, 0)
+
+    def test_progress(self):
+        response = b'x' * 100 + b'>>> '
+        comms = Comms(TrickleTerminal(response, delay=0.002))
+        # Arrives over much longer than the timeout, but keeps arriving.
+        self.assertEqual(comms.read_until(b'>>> ', timeout=0.05), response)
+        self.assertIsNotNone(comms.stats.throughput)
+
+    def test_stall(self):
+        comms = Comms(TrickleTerminal(b'xx'))
+        with self.assertRaises(ValueError):
+            comms.read_until(b'>>> ', timeout=0.05)
+        self.assertEqual(comms.stats.stalls, 1)
+
+
+class StreamTest(TestCase):
+
+    def test_stream(self):
+        comms = Comms(FakeDevice())
+        output = b''.join(comms.stream('for i in range(3): print(i)'))
+        self.assertEqual(output, b'0\n1\n2\n')
+        # Expressions still show their value.
+        self.assertEqual(b''.join(comms.stream('1 + 1')), b'2\n')
+        output = b''.join(comms.stream('x = 1\nprint(x + 1)'))
+        self.assertEqual(output, b'2\n')
+
+    def test_chunks(self):
+        response = b'x\r\n' + b'line\r\n' * 10 + b'>>> '
+        comms = Comms(TrickleTerminal(response, delay=0))
+        chunks = list(comms.stream('x'))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b''.join(chunks), b'line\n' * 10)
+
+    def test_cancel(self):
+        terminal = TrickleTerminal(b'x\r\n' + b'data\r\n' * 100, delay=0)
+        terminal.tx = mock.Mock()
+        comms = Comms(terminal)
+        stream = comms.stream('x')
+        self.assertEqual(next(stream), b'd')
+        stream.close()
+        terminal.tx.assert_called_with(b'\x03')
@@ -0,0 +1,91 @@
+from __future__ import unicode_literals
+import select
+import time
+from unittest import TestCase
+
+from ..reader import Reader, RingBuffer
+
+
+class RingBufferTest(TestCase):
+
+    def test_wrap(self):
+        buffer = RingBuffer(8)
+        buffer.write(b'abcdef')
+        self.assertEqual(buffer.read(4), b'abcd')
+        buffer.write(b'ghijk')
+        self.assertEqual(len(buffer), 7)
+        self.assertEqual(buffer.read(), b'efghijk')
+        self.assertEqual(buffer.dropped, 0)
+
+    def test_drop_oldest(self):
+        buffer = RingBuffer(4)
+        buffer.write(b'abc')
+        buffer.write(b'def')
+        self.assertEqual(buffer.read(), b'cdef')
+        self.assertEqual(buffer.dropped, 2)
+        buffer.write(b'0123456789')
+        self.assertEqual(buffer.read(), b'6789')
+        self.assertEqual(buffer.dropped, 8)
+
+
+class FakePort(object):
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.timeout = None
+
+    def inWaiting(self):
+        if not self.chunks or isinstance(self.chunks[0], Exception):
+            return 0
+        return len(self.chunks[0])
+
+    def read(self, size):
+        if not self.chunks:
+            time.sleep(self.timeout)
+            return b''
+        chunk = self.chunks.pop(0)
+        if isinstance(chunk, Exception):
+            raise chunk
+        return chunk
+
+
+class ReaderTest(TestCase):
+
+    def read_all(self, reader, size):
+        data = b''
+        while len(data) < size:
+            select.select([reader.fileno()], [], [], 1)
+            data += reader.read()
+        return data
+
+    def test_read(self):
+        reader = Reader(FakePort([b'abc', b'def']))
+        reader.start()
+        try:
+            self.assertEqual(self.read_all(reader, 6), b'abcdef')
+            self.assertEqual(reader.in_waiting(), 0)
+        finally:
+            reader.stop()
+
+    def test_full(self):
+        reader = Reader(FakePort([b'abcd', b'efgh']), size=6)
+        reader.backpressure_timeout = 0.01
+        reader.start()
+        try:
+            while reader.backpressured < 1 or reader.in_waiting() < 6:
+                time.sleep(0.001)
+            self.assertEqual(reader.read(), b'cdefgh')
+            self.assertEqual(reader.dropped, 2)
+        finally:
+            reader.stop()
+
+    def test_error(self):
+        reader = Reader(FakePort([b'abc', IOError(5, 'Gone')]))
+        reader.start()
+        try:
+            self.assertEqual(self.read_all(reader, 3), b'abc')
+            select.select([reader.fileno()], [], [], 1)
+            with self.assertRaises(IOError):
+                reader.read()
+        finally:
+            reader.stop()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from unittest import TestCase
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import curses
+import pyte
+
+from ..render import Renderer
+
+
+class RendererTest(TestCase):
+
+    def setUp(self):
+        self.window = mock.Mock()
+        self.screen = pyte.Screen(10, 1)
+        self.stream = pyte.Stream(self.screen)
+
+    def test_changed_runs(self):
+        renderer = Renderer(self.window, colors=False)
+        self.stream.feed('hello')
+        renderer.paint(self.screen)
+        self.window.addstr.assert_called_once_with(0, 0, 'hello     ', 0)
+        self.window.addstr.reset_mock()
+        self.stream.feed('\rjelly')
+        renderer.paint(self.screen)
+        self.assertEqual(self.window.addstr.call_args_list, [
+            mock.call(0, 0, 'j', 0), mock.call(0, 4, 'y', 0)])
+
+    def test_attributes(self):
+        renderer = Renderer(self.window, colors=False)
+        self.stream.feed('a\x1b[1mb\x1b[0mc')
+        renderer.paint(self.screen)
+        self.assertEqual(self.window.addstr.call_args_list, [
+            mock.call(0, 0, 'a', 0), mock.call(0, 1, 'b', curses.A_BOLD),
+            mock.call(0, 2, 'c       ', 0)])
+
+    def test_unicode(self):
+        renderer = Renderer(self.window, colors=False)
+        self.stream.feed('é中x')
+        renderer.paint(self.screen)
+        self.window.addstr.assert_called_once_with(0, 0, 'é中x      ', 0)
+
+    @mock.patch('curses.color_pair', side_effect=lambda n: n << 8)
+    @mock.patch('curses.init_pair')
+    def test_color_pairs(self, init_pair, color_pair):
+        renderer = Renderer(self.window, colors=True)
+        with mock.patch('curses.COLOR_PAIRS', 64, create=True), \
+                mock.patch('curses.COLORS', 8, create=True):
+            self.stream.feed('\x1b[31ma\x1b[32mb\x1b[31mc')
+            renderer.paint(self.screen)
+        self.assertEqual(init_pair.call_args_list, [
+            mock.call(1, curses.COLOR_RED, -1),
+            mock.call(2, curses.COLOR_GREEN, -1)])
+        self.assertEqual(self.window.addstr.call_args_list[:3], [
+            mock.call(0, 0, 'a', 1 << 8), mock.call(0, 1, 'b', 2 << 8),
+            mock.call(0, 2, 'c', 1 << 8)])
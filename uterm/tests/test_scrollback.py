@@ -0,0 +1,81 @@
+from __future__ import unicode_literals
+from unittest import TestCase
+
+import pyte
+
+from ..scrollback import HistoryScreen, Scrollback, Viewer
+
+
+class ScrollbackTest(TestCase):
+
+    def test_append(self):
+        scrollback = Scrollback()
+        scrollback.append('hello', [(5, 1)])
+        scrollback.append('wörld')
+        self.assertEqual(len(scrollback), 2)
+        self.assertEqual(scrollback.get(0), ('hello', ((5, 1),)))
+        self.assertEqual(scrollback.get(1), ('wörld', ()))
+
+    def test_budget(self):
+        scrollback = Scrollback(budget=2000)
+        for i in range(1000):
+            scrollback.append('line %d' % i)
+        self.assertLessEqual(scrollback.size, 2000)
+        self.assertEqual(scrollback.end, 1000)
+        self.assertGreater(scrollback.first, 0)
+        self.assertEqual(scrollback.get(999), ('line 999', ()))
+        first = scrollback.first
+        self.assertEqual(scrollback.get(first), ('line %d' % first, ()))
+        # Evicted lines are dropped from the index.
+        postings = sum(len(numbers) for numbers in scrollback.index.values())
+        self.assertLess(postings, 1000)
+
+    def test_search(self):
+        scrollback = Scrollback()
+        for text in ('Traceback (most recent call last):', 'ok', 'TRACE',
+                     'done'):
+            scrollback.append(text)
+        self.assertEqual(scrollback.search('trace'), 2)
+        self.assertEqual(scrollback.search('trace', before=2), 0)
+        self.assertIsNone(scrollback.search('trace', before=0))
+        self.assertIsNone(scrollback.search('missing'))
+        # Short queries can't use the index.
+        self.assertEqual(scrollback.search('ok'), 1)
+
+    def test_search_evicted(self):
+        scrollback = Scrollback(budget=1000)
+        scrollback.append('needle')
+        for i in range(100):
+            scrollback.append('hay %d' % i)
+        self.assertIsNone(scrollback.search('needle'))
+        self.assertIsNone(scrollback.search('ne'))
+        self.assertEqual(scrollback.search('hay 99'), 100)
+
+
+class HistoryScreenTest(TestCase):
+
+    def test_scrolled_lines(self):
+        scrollback = Scrollback()
+        screen = HistoryScreen(
+            10, 2, scrollback, attribute=lambda char: int(char.bold))
+        stream = pyte.Stream(screen)
+        stream.feed('one\r\n\x1b[1mtwo\x1b[0m!\r\nthree\r\n')
+        self.assertEqual(
+            [scrollback.get(i) for i in range(len(scrollback))],
+            [('one', ((3, 0),)), ('two!', ((3, 1), (1, 0)))])
+        self.assertEqual(screen.display[0].rstrip(), 'three')
+
+
+class ViewerTest(TestCase):
+
+    def test_search(self):
+        scrollback = Scrollback()
+        scrollback.append('error one')
+        scrollback.append('fine')
+        viewer = Viewer(scrollback, ['Error two', '>>> '])
+        self.assertEqual(viewer.end, 4)
+        viewer.query = 'error'
+        self.assertEqual(viewer.search(), 2)
+        self.assertEqual(viewer.search(2), 0)
+        self.assertIsNone(viewer.search(0))
+        self.assertEqual(viewer.line(3), ('>>> ', ()))
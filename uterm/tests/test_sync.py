@@ -0,0 +1,62 @@
+from __future__ import unicode_literals
+import os
+from unittest import TestCase
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from ..sync import Sync
+from .fake import FakeDevice, TempDirMixin
+
+
+class SyncTest(TempDirMixin, TestCase):
+
+    def setUp(self):
+        super(SyncTest, self).setUp()
+        os.makedirs(os.path.join('local', 'lib'))
+        self.write('local/main.py', b'import lib.util')
+        self.write('local/lib/util.py', b'print(1)')
+        self.device = FakeDevice()
+
+    def test_sync(self):
+        sync = Sync('local', 'remote')
+        sync(self.device)
+        self.assertEqual(
+            sync.uploaded, ['remote/lib/util.py', 'remote/main.py'])
+        with open('remote/lib/util.py', 'rb') as f:
+            self.assertEqual(f.read(), b'print(1)')
+
+        sync(self.device)
+        self.assertEqual(sync.uploaded, [])
+        self.assertEqual(len(sync.unchanged), 2)
+
+        self.write('local/lib/util.py', b'print(2)')
+        sync(self.device)
+        self.assertEqual(sync.uploaded, ['remote/lib/util.py'])
+
+    def test_prune(self):
+        Sync('local', 'remote')(self.device)
+        os.remove('local/lib/util.py')
+        os.rmdir('local/lib')
+        sync = Sync('local', 'remote', prune=True)
+        sync(self.device)
+        self.assertEqual(sync.removed, ['remote/lib/util.py', 'remote/lib'])
+        self.assertEqual(os.listdir('remote'), ['main.py'])
+
+    def test_default_remote_dir(self):
+        # The device's current directory.
+        sync = Sync('local')
+        sync(self.device)
+        self.assertEqual(sync.uploaded, ['lib/util.py', 'main.py'])
+        sync(self.device)
+        self.assertEqual(sync.uploaded, [])
+        self.assertEqual(sync.unchanged, ['lib/util.py', 'main.py'])
+
+    def test_failure_leaves_raw(self):
+        sync = Sync('local', 'remote')
+        with mock.patch.object(
+                sync, 'remote_hashes', side_effect=ValueError('Timeout')):
+            self.assertRaises(ValueError, sync, self.device)
+        self.assertFalse(self.device.comms.raw)
+        self.assertEqual(self.device.mode, 'friendly')
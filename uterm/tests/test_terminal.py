@@ -1,5 +1,9 @@
 from __future__ import unicode_literals
+import os
 from unittest import TestCase
+
+import curses
+import pyte
 try:
     from unittest import mock
 except ImportError:
@@ -22,6 +26,11 @@ class TerminalTest(TestCase):
         mock_port.is_open = False
         self.assertFalse(terminal.running)
 
+    def test_comms(self):
+        terminal = Terminal(mock.Mock())
+        self.assertIs(terminal.comms, terminal.comms)
+        terminal.port.write.assert_called_once_with(b'\x03')
+
 
 class TXTest(TestCase):
     CTRL_A = b'\x01'
@@ -106,10 +115,106 @@ class RXTest(TestCase):
         # Set up some things created in __call__
         terminal.window = mock.Mock()
         terminal.screen_stream = mock.Mock()
-        terminal.screen = mock.MagicMock()
-        terminal.screen.display = ['']
-        terminal.screen.dirty.__iter__.return_value = range(1)
-
-        range(1)
+        terminal.screen = pyte.Screen(10, 1)
 
         self.assertEqual(terminal.rx(), expected)
+
+    def test_watched(self):
+        mock_port = mock.Mock()
+        terminal = Terminal(mock_port)
+        terminal._comms = mock.Mock()
+        mock_port.inWaiting.return_value = 4
+        mock_port.read.return_value = b'test'
+        terminal.rx(silent=True)
+        terminal._comms.watch.assert_called_with(b'test')
+
+
+class RenderTest(TestCase):
+
+    def setUp(self):
+        self.terminal = Terminal(mock.Mock())
+        self.terminal.window = mock.Mock()
+        self.terminal.screen = pyte.Screen(10, 2)
+        self.stream = pyte.Stream(self.terminal.screen)
+        self.stream.feed('ab')
+
+    def test_frame_rate(self):
+        self.terminal.frame_rate = 10
+        self.assertTrue(self.terminal.render())
+        self.assertEqual(self.terminal.window.addstr.call_count, 2)
+        self.assertIsNone(self.terminal.next_frame())
+        # Changes within the frame wait for the next one.
+        self.stream.feed('c')
+        self.assertFalse(self.terminal.render())
+        self.assertGreater(self.terminal.next_frame(), 0)
+        self.assertTrue(self.terminal.render(force=True))
+        self.assertEqual(self.terminal.window.addstr.call_count, 3)
+        # Only the changed cell is painted.
+        self.terminal.window.addstr.assert_called_with(0, 2, 'c', 0)
+
+    def test_uncapped(self):
+        self.terminal.frame_rate = None
+        self.assertTrue(self.terminal.render())
+        self.assertTrue(self.terminal.render())
+
+
+class WaitTest(TestCase):
+
+    def test_waiting(self):
+        mock_port = mock.Mock()
+        mock_port.inWaiting.return_value = 1
+        self.assertTrue(Terminal(mock_port).wait(1))
+
+    def test_select(self):
+        read, write = os.pipe()
+        try:
+            mock_port = mock.Mock()
+            mock_port.inWaiting.return_value = 0
+            mock_port.fileno.return_value = read
+            terminal = Terminal(mock_port)
+            self.assertFalse(terminal.wait(0.01))
+            os.write(write, b'x')
+            self.assertTrue(terminal.wait(1))
+        finally:
+            os.close(read)
+            os.close(write)
+
+    def test_no_fileno(self):
+        mock_port = mock.Mock()
+        mock_port.inWaiting.return_value = 0
+        mock_port.fileno.side_effect = AttributeError
+        self.assertFalse(Terminal(mock_port).wait(1))
+
+
+class LoopTest(TestCase):
+
+    def setUp(self):
+        self.port_read, self.port_write = os.pipe()
+        self.key_read, self.key_write = os.pipe()
+        self.port = mock.Mock()
+        self.port.inWaiting.return_value = 0
+        self.port.fileno.return_value = self.port_read
+        self.terminal = Terminal(self.port)
+        self.terminal.input_fd = self.key_read
+
+    def tearDown(self):
+        for fd in (self.port_read, self.port_write, self.key_read,
+                   self.key_write):
+            os.close(fd)
+
+    def test_wait_input(self):
+        self.assertFalse(self.terminal.wait_input(0.01))
+        os.write(self.key_write, b'x')
+        self.assertTrue(self.terminal.wait_input())
+        os.read(self.key_read, 1)
+        os.write(self.port_write, b'x')
+        self.assertTrue(self.terminal.wait_input())
+
+    def test_loop_sends_keys(self):
+        os.write(self.key_write, b'x')
+        self.terminal.window = mock.Mock()
+        self.terminal.window.getkey.side_effect = ['a', 'b', curses.error]
+        self.terminal.rx = mock.Mock(
+            side_effect=lambda: setattr(self.port, 'is_open', False))
+        self.terminal.loop()
+        self.port.write.assert_called_once_with(b'ab')